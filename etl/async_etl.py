@@ -0,0 +1,293 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+import asyncpg
+import orjson
+
+from changeset import ChangeSet, Tombstones, chunked
+from dimensions import FilmDimensions
+from fingerprint import FingerprintCache
+from load_to_elastic import AsyncLoadElastic
+from pipeline import AsyncPipeline
+from postgres_extract import PostgresExtract
+from schemas import EtlSettings, FilmworkSchemaOut, GenreSchemaOut, PersonSchemaOut
+from state import State, load_cursor, save_cursor
+from transform import raw_transform
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """Отдавать uuid строками, а json - разобранным, как это делает psycopg2."""
+    await conn.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog', format='text')
+    for name in ('json', 'jsonb'):
+        await conn.set_type_codec(
+            name, encoder=lambda value: orjson.dumps(value).decode(), decoder=orjson.loads,
+            schema='pg_catalog')
+
+
+def create_pool(dsl: dict, size: int) -> asyncpg.Pool:
+    return asyncpg.create_pool(
+        database=dsl['dbname'], user=dsl['user'], password=dsl['password'],
+        host=dsl['host'], port=dsl['port'],
+        min_size=1, max_size=size, init=init_connection,
+    )
+
+
+class AsyncPostgresExtract(PostgresExtract):
+    """Доступ к postgres через пул соединений asyncpg.
+
+    Запросы те же, что у PostgresExtract; методы, которые читают данные
+    пачками, отдают асинхронные итераторы, остальные - корутины.
+    """
+
+    # asyncpg типизирует параметры, поэтому курсор передается строками.
+    KEYSET_PARAMS = '($1::text::timestamptz, $2::uuid)'
+
+    def __init__(self, pool: asyncpg.Pool, itersize: int = PostgresExtract.LIMIT, shard=None):
+        self.pool = pool
+        self.itersize = itersize
+        self.shard = shard
+        self.batch = None
+
+    def __del__(self):
+        pass
+
+    async def fetch(self, query: str, params: tuple = ()) -> list:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(query, *params)
+
+    async def stream_data(self, query: str, params: tuple = ()) -> AsyncIterator[list]:
+        """Читать результат запроса серверным курсором пачками по itersize строк."""
+        async with self.pool.acquire() as conn, conn.transaction():
+            cursor = await conn.cursor(query, *params)
+            while rows := await cursor.fetch(self.fetch_size):
+                yield rows
+
+    def _keyset(self, modified, last_id) -> tuple:
+        if isinstance(modified, datetime):
+            modified = modified.isoformat()
+        return modified or self.MIN_MODIFIED, last_id or self.MIN_ID
+
+    async def iter_ids_modified_data(self, table: str, modified, last_id) -> AsyncIterator[tuple[tuple, list]]:
+        query = self._ids_modified_query(table)
+        while rows := await self.fetch(query, self._keyset(modified, last_id)):
+            modified, last_id = rows[-1]['modified'], rows[-1]['id']
+            yield (modified, last_id), [row['id'] for row in rows]
+
+    async def get_ids_data_modified(self, table: str, ids: list[str]):
+        if table in ('film_work', 'film_work_doc'):
+            return ids
+        link_table, column = {
+            'person': ('person_film_work', 'person_id'),
+            'genre': ('genre_film_work', 'genre_id'),
+        }[table]
+        rows = await self.fetch(self._film_work_by_link_query(link_table, column, ids))
+        return tuple(row['film_work_id'] for row in rows)
+
+    async def iter_person_ids_by_new_links(self, created, last_id) -> AsyncIterator[tuple[tuple, list]]:
+        query = self._person_links_query()
+        while rows := await self.fetch(query, self._keyset(created, last_id)):
+            created, last_id = rows[-1]['created'], rows[-1]['id']
+            yield (created, last_id), list(dict.fromkeys(row['person_id'] for row in rows))
+
+    async def get_genre_names(self, ids_genre: list[str]) -> dict[str, str]:
+        return dict(await self.fetch(self._names_query('genre', 'name', ids_genre)))
+
+    async def get_person_names(self, ids_person: list[str]) -> dict[str, str]:
+        return dict(await self.fetch(self._names_query('person', 'full_name', ids_person)))
+
+    async def get_deleted_rows(self) -> list:
+        return await self.fetch(self._deleted_rows_query())
+
+    async def remove_deleted_rows(self, ids: list[int]) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(self._remove_deleted_rows_query(ids))
+
+    async def _iter_modified(self, query: str, modified, last_id):
+        async for rows in self.stream_data(query, self._keyset(modified, last_id)):
+            last_row = rows[-1]
+            yield (last_row['modified'], last_row['id']), rows
+
+
+class AsyncRuntime:
+    """Цикл ETL на asyncio.
+
+    Пул соединений Postgres и клиент Elasticsearch создаются один раз на
+    процесс, фильмы, жанры и персоны загружаются одновременно, а каждый
+    конвейер держит в полете до ETL_BULKS_IN_FLIGHT bulk-запросов.
+    """
+
+    def __init__(self, dsl: dict, elastic_conn: dict, state: State, settings: EtlSettings,
+                 fingerprints: Optional[FingerprintCache] = None,
+                 dimensions: Optional[FilmDimensions] = None):
+        self.dsl = dsl
+        self.elastic_conn = elastic_conn
+        self.state = state
+        self.settings = settings
+        self.fingerprints = fingerprints
+        self.dimensions = dimensions
+
+    async def run(self, sleep: float) -> None:
+        async with create_pool(self.dsl, self.settings.pg_pool_size) as pool:
+            self.extract = AsyncPostgresExtract(pool, itersize=self.settings.itersize)
+            self.elastic = AsyncLoadElastic(**self.elastic_conn)
+            try:
+                while True:
+                    await self.run_sweep()
+                    await asyncio.sleep(sleep)
+            finally:
+                await self.elastic.close()
+
+    async def run_sweep(self) -> None:
+        # Удаления идут до остальных проходов, как и в синхронном режиме.
+        results = await asyncio.gather(self.process_deletions(), return_exceptions=True)
+        results += await asyncio.gather(
+            self.process_movies(), self.process_genres(), self.process_persons(),
+            return_exceptions=True,
+        )
+        self.state.flush()
+        for result in results:
+            if isinstance(result, (OSError, asyncpg.PostgresConnectionError)):
+                logging.error('Connection refused')
+            elif isinstance(result, BaseException):
+                raise result
+
+    async def run_pipeline(self, source, schema, index: str, checkpoint, raw: bool = False) -> None:
+        send = self.elastic.send_raw_to_es if raw else self.elastic.send_data_to_es
+
+        async def load(docs):
+            if self.fingerprints is not None:
+                docs, hashes = await asyncio.to_thread(self.fingerprints.filter_changed, index, docs)
+            if docs:
+                report = await send(docs, index)
+                if self.fingerprints is not None:
+                    await asyncio.to_thread(
+                        self.fingerprints.update, index, hashes,
+                        failed=[error.get('_id') for error in report.errors])
+
+        await AsyncPipeline(
+            transform=(raw_transform(schema, self.settings.validate_every) if raw
+                       else lambda rows: [schema(**row) for row in rows]),
+            load=load,
+            checkpoint=checkpoint,
+            transform_workers=self.settings.transform_workers,
+            load_workers=self.settings.bulks_in_flight,
+            queue_size=self.settings.queue_size,
+            name=index,
+        ).run(source)
+
+    def invalidate_dimensions(self, table: str, ids) -> None:
+        if self.dimensions is not None:
+            self.dimensions.invalidate(table, ids)
+
+    async def invalidating_source(self, source, table: str):
+        async for cursor, rows in source:
+            self.invalidate_dimensions(table, [row['id'] for row in rows])
+            yield cursor, rows
+
+    async def extract_enriched_film_works(self, ids_film_work: list[str]):
+        async for rows in self.extract.get_film_work_links(ids_film_work):
+            yield await self.dimensions.aenrich(
+                rows, self.extract.get_genre_names, self.extract.get_person_names)
+
+    async def extract_film_works(self, ids_film_work: list[str], cursors: dict, raw: bool):
+        if not raw and self.dimensions is not None:
+            extract = self.extract_enriched_film_works
+        elif not raw:
+            extract = self.extract.get_all_data_film_work
+        elif self.settings.film_work_doc:
+            extract = self.extract.get_film_work_documents_from_table
+        else:
+            extract = self.extract.get_film_work_documents
+        for ids in chunked(ids_film_work, self.extract.page_size):
+            async for data in extract(ids):
+                yield None, data
+        yield cursors, []
+
+    async def index_change_set(self, change_set: ChangeSet, index: str) -> None:
+        ids_film_work, cursors = change_set.flush()
+
+        def checkpoint(cursors):
+            for table, cursor in cursors.items():
+                save_cursor(self.state, table, cursor)
+
+        raw = self.settings.transform_mode == 'raw'
+        await self.run_pipeline(
+            self.extract_film_works(ids_film_work, cursors, raw),
+            FilmworkSchemaOut, index, checkpoint, raw=raw,
+        )
+
+    async def process_movies(self, index: str = 'movies') -> None:
+        tables = ('film_work_doc',) if self.settings.film_work_doc else ('film_work', 'genre', 'person')
+        change_set = ChangeSet()
+
+        for table in tables:
+            pages = self.extract.iter_ids_modified_data(table, *load_cursor(self.state, table))
+            async for cursor, ids_modified in pages:
+                if table in ('genre', 'person'):
+                    self.invalidate_dimensions(table, ids_modified)
+                change_set.add(table, await self.extract.get_ids_data_modified(table, ids_modified), cursor)
+                if len(change_set) >= self.settings.changeset_max_ids:
+                    await self.index_change_set(change_set, index)
+
+        if change_set.cursors:
+            await self.index_change_set(change_set, index)
+        if not change_set.indexed:
+            logging.info('Обновленных данных по фильмам нет.')
+        change_set.log_stats()
+
+    async def process_deletions(self) -> None:
+        while rows := await self.extract.get_deleted_rows():
+            tombstones = Tombstones(rows)
+            self.invalidate_dimensions('genre', tombstones.deleted['genres'])
+            self.invalidate_dimensions('person', tombstones.deleted['persons'])
+            for index, ids in tombstones.deleted.items():
+                if not ids:
+                    continue
+                await self.elastic.delete_from_es(ids, index)
+                if self.fingerprints is not None:
+                    await asyncio.to_thread(self.fingerprints.discard, index, ids)
+
+            change_set = ChangeSet()
+            change_set.add('links', tombstones.film_work_ids)
+            await self.index_change_set(change_set, 'movies')
+            await self.run_pipeline(
+                self.extract_persons(tombstones.person_ids), PersonSchemaOut, 'persons', lambda _: None)
+
+            await self.extract.remove_deleted_rows(tombstones.log_ids)
+            logging.info(f'Deletions applied: {len(tombstones.log_ids)} log rows')
+
+    async def extract_persons(self, ids_person):
+        for chunk in chunked(ids_person, self.extract.page_size):
+            async for data in self.extract.get_persons_by_ids(chunk):
+                yield None, data
+
+    async def process_genres(self, index: str = 'genres') -> None:
+        key_state = 'genres_table'
+        await self.run_pipeline(
+            self.invalidating_source(
+                self.extract.iter_modified_genres(*load_cursor(self.state, key_state)), 'genre'),
+            GenreSchemaOut, index,
+            lambda cursor: save_cursor(self.state, key_state, cursor),
+        )
+
+    async def extract_persons_by_new_links(self, cursor: tuple):
+        async for page_cursor, ids_person in self.extract.iter_person_ids_by_new_links(*cursor):
+            async for data in self.extract.get_persons_by_ids(ids_person):
+                yield None, data
+            yield page_cursor, []
+
+    async def process_persons(self, index: str = 'persons') -> None:
+        key_state, key_links = 'persons_table', 'person_film_work'
+        await self.run_pipeline(
+            self.invalidating_source(
+                self.extract.iter_modified_persons(*load_cursor(self.state, key_state)), 'person'),
+            PersonSchemaOut, index,
+            lambda cursor: save_cursor(self.state, key_state, cursor),
+        )
+        await self.run_pipeline(
+            self.extract_persons_by_new_links(load_cursor(self.state, key_links)),
+            PersonSchemaOut, index,
+            lambda cursor: save_cursor(self.state, key_links, cursor),
+        )
@@ -0,0 +1,55 @@
+import threading
+
+import metrics
+
+
+class AdaptiveBatchSize:
+    """Размер пачки, подстраиваемый по результатам предыдущих пачек.
+
+    После каждой пачки размер сдвигается к тому, при котором запрос весил
+    бы target_bytes и выполнялся бы target_latency секунд. При отказах 429
+    размер сразу уменьшается вдвое. За один шаг размер меняется не больше
+    чем вдвое, чтобы одна быстрая пачка не раздувала следующую.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 500,
+        minimum: int = 50,
+        maximum: int = 5000,
+        target_bytes: int = 5 * 1024 * 1024,
+        target_latency: float = 1.0,
+        smoothing: float = 0.5,
+    ):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.size = self._clamp(initial)
+
+    def observe(self, count: int, seconds: float, nbytes: int = 0, rejected: int = 0) -> int:
+        """Учесть пачку из count строк и вернуть новый размер."""
+        if count <= 0:
+            return self.size
+        with self._lock:
+            if rejected:
+                target = self.size / 2
+            else:
+                # Сколько строк уложилось бы в цель при той же цене строки.
+                limits = [count * self.target_latency / seconds] if seconds > 0 else []
+                if nbytes > 0:
+                    limits.append(count * self.target_bytes / nbytes)
+                if not limits:
+                    return self.size
+                target = self.size + (min(limits) - self.size) * self.smoothing
+                target = min(max(target, self.size / 2), self.size * 2)
+            self.size = self._clamp(target)
+        metrics.adaptive_batch_size.set(self.size, name=self.name)
+        return self.size
+
+    def _clamp(self, size: float) -> int:
+        return int(min(max(size, self.minimum), self.maximum))
@@ -0,0 +1,96 @@
+"""Генератор синтетического каталога в формате исходной базы SQLite.
+
+Таблицы и колонки совпадают с теми, что читает SQLiteExtractor, поэтому
+каталог загружается в схему content обычным migrate_from_sqlite.
+
+Запуск из каталога etl:
+    python -m benchmarks.catalog bench.sqlite --films 100000 --persons 50000
+"""
+import argparse
+import random
+import sqlite3
+import uuid
+from contextlib import closing
+from typing import NamedTuple
+
+ROLES = ('actor', 'writer', 'director')
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS genre (id TEXT PRIMARY KEY, name TEXT NOT NULL, description TEXT);
+CREATE TABLE IF NOT EXISTS person (id TEXT PRIMARY KEY, full_name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS film_work (
+    id TEXT PRIMARY KEY, title TEXT NOT NULL, description TEXT, type TEXT NOT NULL, rating FLOAT);
+CREATE TABLE IF NOT EXISTS genre_film_work (id TEXT PRIMARY KEY, genre_id TEXT, film_work_id TEXT);
+CREATE TABLE IF NOT EXISTS person_film_work (
+    id TEXT PRIMARY KEY, person_id TEXT NOT NULL, film_work_id TEXT NOT NULL, role TEXT);
+"""
+
+
+class CatalogSize(NamedTuple):
+    films: int = 10000
+    persons: int = 5000
+    genres: int = 30
+    genres_per_film: int = 3
+    persons_per_film: int = 10
+
+
+def generate_catalog(path: str, size: CatalogSize, seed: int = 0, batch: int = 10000) -> dict[str, int]:
+    """Записать каталог в файл SQLite и вернуть число строк по таблицам."""
+    rnd = random.Random(seed)
+
+    def new_id() -> str:
+        return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+    genre_ids = [new_id() for _ in range(size.genres)]
+    person_ids = [new_id() for _ in range(size.persons)]
+    counts = dict.fromkeys(('genre', 'person', 'film_work', 'genre_film_work', 'person_film_work'), 0)
+
+    with closing(sqlite3.connect(path)) as conn:
+        conn.executescript(SQLITE_SCHEMA)
+
+        def insert(table: str, rows: list[tuple]) -> None:
+            if rows:
+                conn.executemany(
+                    f'INSERT INTO {table} VALUES ({", ".join("?" * len(rows[0]))});', rows)
+                counts[table] += len(rows)
+
+        insert('genre', [(genre_id, f'Genre {number}', f'Description of genre {number}')
+                         for number, genre_id in enumerate(genre_ids)])
+        for start in range(0, size.persons, batch):
+            insert('person', [(person_id, f'Person {start + number}')
+                              for number, person_id in enumerate(person_ids[start:start + batch])])
+
+        films, genre_links, person_links = [], [], []
+        for number in range(size.films):
+            film_id = new_id()
+            films.append((film_id, f'Film {number}', 'Synthetic film description. ' * rnd.randint(1, 20),
+                          rnd.choice(('movie', 'tv_show')), round(rnd.uniform(0, 10), 1)))
+            genre_links += [(new_id(), genre_id, film_id)
+                            for genre_id in rnd.sample(genre_ids, min(size.genres_per_film, size.genres))]
+            person_links += [(new_id(), person_id, film_id, rnd.choice(ROLES))
+                             for person_id in rnd.sample(person_ids, min(size.persons_per_film, size.persons))]
+            if len(films) >= batch:
+                insert('film_work', films)
+                insert('genre_film_work', genre_links)
+                insert('person_film_work', person_links)
+                films, genre_links, person_links = [], [], []
+        insert('film_work', films)
+        insert('genre_film_work', genre_links)
+        insert('person_film_work', person_links)
+        conn.commit()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    for field, default in CatalogSize._field_defaults.items():
+        parser.add_argument(f'--{field.replace("_", "-")}', type=int, default=default)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    size = CatalogSize(**{field: getattr(args, field) for field in CatalogSize._fields})
+    print(generate_catalog(args.path, size, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Бенчмарк ETL: SQLite -> Postgres -> фейковый Elasticsearch.
+
+Генерирует синтетический каталог, загружает его в локальный Postgres
+тем же migrate_from_sqlite, что и ETL (INSERT или COPY, см.
+ETL_SQLITE_LOADER), и прогоняет process_etl_movies/genres/persons в
+фейковый bulk-эндпоинт. По каждой стадии выводятся строки в секунду,
+p50/p99 задержки пачки и пиковый RSS. Каждая стадия идет в отдельном
+процессе, поэтому пиковый RSS - ее собственный.
+Результат сохраняется в json и может сравниваться с прошлым базовым
+прогоном.
+
+Postgres берется из enviroments/.env, схема content пересоздается.
+
+Запуск из каталога etl:
+    python -m benchmarks.suite --films 20000 --output bench.json --baseline baseline.json
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Кэш отпечатков отбросил бы повторные документы и исказил замер.
+os.environ.setdefault('ETL_FINGERPRINT_PATH', '')
+
+import psycopg2  # noqa: E402
+
+import main as etl  # noqa: E402
+from benchmarks.catalog import CatalogSize, generate_catalog  # noqa: E402
+from config import dsl  # noqa: E402
+from load_to_elastic import LoadElastic  # noqa: E402
+from schemas import ElasticSettings  # noqa: E402
+from sqlite_to_postgres import CopyPostgresSaver, PostgresSaver, migrate_from_sqlite  # noqa: E402
+from state import MemoryStorage, State  # noqa: E402
+
+# Допустимое падение rows/sec относительно базового прогона.
+REGRESSION_THRESHOLD = 0.1
+
+
+class FakeElasticHandler(BaseHTTPRequestHandler):
+    """Bulk-эндпоинт, который принимает все документы и ничего не хранит."""
+
+    def _reply(self, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def do_POST(self):
+        body = self._read_body()
+        if not self.path.split('?')[0].endswith('_bulk'):
+            return self._reply({'acknowledged': True})
+        items, lines, position = [], body.splitlines(), 0
+        while position < len(lines):
+            (operation, meta), = json.loads(lines[position]).items()
+            items.append({operation: {'_id': meta.get('_id'), 'status': 201}})
+            # За delete не следует строка с документом.
+            position += 1 if operation == 'delete' else 2
+        self._reply({'took': 1, 'errors': False, 'items': items})
+
+    do_PUT = do_POST
+
+    def do_GET(self):
+        self._reply({'version': {'number': '8.5.3'}, 'tagline': 'You Know, for Search'})
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def fake_elastic():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeElasticHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+
+
+class StageRecorder:
+    """Замеряет задержку каждой пачки, подменяя метод класса на время стадии."""
+
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str, owner, method: str, count_rows):
+        latencies, rows = [], [0]
+        original = getattr(owner, method)
+        # Таблицы миграции пишутся из нескольких потоков.
+        lock = threading.Lock()
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            result = original(*args, **kwargs)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                rows[0] += count_rows(args, kwargs)
+            return result
+
+        setattr(owner, method, timed)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(owner, method, original)
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self._summary(rows[0], elapsed, latencies)
+
+    @staticmethod
+    def _summary(rows: int, elapsed: float, latencies: list[float]) -> dict:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed, 1) if elapsed else 0,
+            'batches': len(latencies),
+            'p50_ms': round(quantiles[49] * 1000, 2) if quantiles else 0,
+            'p99_ms': round(quantiles[98] * 1000, 2) if quantiles else 0,
+            # ru_maxrss в Linux в килобайтах, пик с начала процесса стадии.
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+
+def reset_schema() -> None:
+    with psycopg2.connect(**dsl) as pg_conn, pg_conn.cursor() as curs:
+        curs.execute('DROP SCHEMA IF EXISTS content CASCADE;')
+
+
+def in_subprocess(stage, *args) -> dict:
+    """Выполнить стадию в новом процессе: ru_maxrss растет монотонно и
+    в общем процессе показывал бы пик всех предыдущих стадий."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(stage, args)
+
+
+def migrate_stage(sqlite_path: str) -> dict:
+    """Миграция SQLite -> Postgres тем же путем, что при старте ETL."""
+    recorder = StageRecorder()
+    saver = CopyPostgresSaver if etl.etl_settings.sqlite_loader == 'copy' else PostgresSaver
+    with recorder.stage('migrate_from_sqlite', saver, 'save_batch', lambda args, kwargs: len(args[2])):
+        migrate_from_sqlite(sqlite_path, dsl, saver=saver, parallel=etl.etl_settings.sqlite_parallel)
+    return recorder.stages['migrate_from_sqlite']
+
+
+def etl_stage(name: str, es_host: str) -> dict:
+    """Полный проход ETL по одному индексу в фейковый Elasticsearch."""
+    recorder = StageRecorder()
+    process = {'movies': etl.process_etl_movies, 'genres': etl.process_etl_genres,
+               'persons': etl.process_etl_persons}[name]
+    raw = name == 'movies' and etl.etl_settings.transform_mode == 'raw'
+    method = 'send_raw_to_es' if raw else 'send_data_to_es'
+    with recorder.stage(name, LoadElastic, method, lambda args, kwargs: len(args[1])):
+        process(ElasticSettings(es_host=es_host).dict(), State(MemoryStorage()))
+    return recorder.stages[name]
+
+
+def run(size: CatalogSize) -> dict:
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_path = os.path.join(tmp, 'bench.sqlite')
+        counts = generate_catalog(sqlite_path, size)
+        reset_schema()
+        stages['migrate_from_sqlite'] = in_subprocess(migrate_stage, sqlite_path)
+
+    with fake_elastic() as es_host:
+        for name in ('movies', 'genres', 'persons'):
+            stages[name] = in_subprocess(etl_stage, name, es_host)
+
+    return {'catalog': size._asdict(), 'rows': counts, 'stages': stages}
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    """Стадии, где rows/sec упало больше допустимого."""
+    regressions = []
+    for name, stage in report['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base or not base['rows_per_sec']:
+            continue
+        change = stage['rows_per_sec'] / base['rows_per_sec'] - 1
+        print(f'{name:>16}: {change:+.1%} rows/sec vs baseline')
+        if change < -REGRESSION_THRESHOLD:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for field, default in CatalogSize._field_defaults.items():
+        parser.add_argument(f'--{field.replace("_", "-")}', type=int, default=default)
+    parser.add_argument('--output', help='сохранить результат в json')
+    parser.add_argument('--baseline', help='сравнить с сохраненным результатом')
+    args = parser.parse_args()
+
+    report = run(CatalogSize(**{field: getattr(args, field) for field in CatalogSize._fields}))
+    for name, stage in report['stages'].items():
+        print(f'{name:>16}: {stage["rows_per_sec"]:>10} rows/sec  p50 {stage["p50_ms"]} ms  '
+              f'p99 {stage["p99_ms"]} ms  peak RSS {stage["peak_rss_mb"]} MB')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if regressions := compare(report, json.load(f)):
+                sys.exit(f'Regression in: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Сравнение скорости двух путей преобразования документов фильмов.
+
+pydantic: FilmworkSchemaOut(**row) и строки ndjson из LoadElastic._actions
+(.dict() и orjson), как в send_data_to_es.
+raw: готовый json из Postgres (json_build_object) передается в строки
+LoadElastic._raw_actions как есть, схема проверяет каждый N-й документ.
+
+Сборка json в Postgres в замер не входит: для raw строки готовятся заранее.
+
+Запуск из каталога etl:
+    python -m benchmarks.transform --docs 20000 --cast 20
+"""
+import argparse
+import random
+import time
+import uuid
+
+import orjson
+
+from load_to_elastic import LoadElastic, RawDocument
+from schemas import FilmworkSchemaOut
+from transform import raw_transform
+
+
+def make_row(cast: int) -> dict:
+    """Строка в формате PostgresExtract.get_all_data_film_work."""
+    actors = [{'id': str(uuid.uuid4()), 'name': f'Actor {random.randint(0, 10 ** 6)}'} for _ in range(cast)]
+    writers = [{'id': str(uuid.uuid4()), 'name': f'Writer {random.randint(0, 10 ** 6)}'} for _ in range(cast // 4 + 1)]
+    return {
+        'id': str(uuid.uuid4()),
+        'imdb_rating': round(random.uniform(0, 10), 1),
+        'genre': ['Action', 'Drama'],
+        'title': f'Film {random.randint(0, 10 ** 6)}',
+        'description': 'Lorem ipsum dolor sit amet. ' * 20,
+        'director': ['Director'],
+        'actors_names': [actor['name'] for actor in actors],
+        'writers_names': [writer['name'] for writer in writers],
+        'actors': actors,
+        'writers': writers,
+    }
+
+
+def bench_pydantic(rows: list[dict]) -> float:
+    started = time.perf_counter()
+    LoadElastic._actions([FilmworkSchemaOut(**row) for row in rows], 'movies')
+    return time.perf_counter() - started
+
+
+def bench_raw(rows: list[dict], validate_every: int) -> float:
+    transform = raw_transform(FilmworkSchemaOut, validate_every)
+    started = time.perf_counter()
+    docs: list[RawDocument] = transform(rows)
+    LoadElastic._raw_actions(docs, 'movies')
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--cast', type=int, default=20, help='актеров в фильме')
+    parser.add_argument('--validate-every', type=int, default=100)
+    args = parser.parse_args()
+
+    rows = [make_row(args.cast) for _ in range(args.docs)]
+    raw_rows = [{'id': row['id'], 'doc': orjson.dumps(row).decode()} for row in rows]
+
+    pydantic_time = bench_pydantic(rows)
+    raw_time = bench_raw(raw_rows, args.validate_every)
+    print(f'pydantic: {args.docs / pydantic_time:,.0f} docs/sec')
+    print(f'raw:      {args.docs / raw_time:,.0f} docs/sec (validate 1 in {args.validate_every})')
+    print(f'speedup:  {pydantic_time / raw_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import logging
+from collections import Counter, defaultdict
+from typing import Any, Iterable, Iterator
+
+import metrics
+
+
+def chunked(ids: Iterable, size: int) -> Iterator[list]:
+    """Разбить коллекцию id на списки не длиннее size."""
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+class ChangeSet:
+    """Фильмы, затронутые изменениями за цикл, без повторов.
+
+    Проходы по film_work, genre и person сначала складывают сюда id
+    фильмов и свои курсоры, а затем каждый фильм обогащается и
+    индексируется один раз, сколько бы источников на него ни указало.
+    """
+
+    def __init__(self):
+        self.film_work_ids: dict[str, None] = {}
+        self.cursors: dict[str, Any] = {}
+        self.received: Counter = Counter()
+        self.indexed = 0
+        self._added = 0
+
+    def __len__(self) -> int:
+        return len(self.film_work_ids)
+
+    def add(self, source: str, ids: Iterable[str], cursor: Any = None) -> None:
+        """Добавить id фильмов из источника и его курсор."""
+        ids = list(ids)
+        self.received[source] += len(ids)
+        self._added += len(ids)
+        metrics.changeset_received.inc(len(ids), source=source)
+        self.film_work_ids.update(dict.fromkeys(ids))
+        if cursor is not None:
+            self.cursors[source] = cursor
+
+    def flush(self) -> tuple[list[str], dict[str, Any]]:
+        """Забрать накопленные id и курсоры, очистив набор."""
+        ids, cursors = list(self.film_work_ids), self.cursors
+        self.indexed += len(ids)
+        metrics.changeset_deduplicated.inc(self._added - len(ids))
+        self._added = 0
+        self.film_work_ids, self.cursors = {}, {}
+        return ids, cursors
+
+    def log_stats(self) -> None:
+        received = sum(self.received.values())
+        saved = received - self.indexed
+        logging.info(
+            f'Change set: received {received} film ids ({dict(self.received)}), '
+            f'indexed {self.indexed}, saved {saved}'
+        )
+
+
+class Tombstones:
+    """Страница журнала удалений, разобранная по индексам.
+
+    Удаленные фильмы, жанры и персоны убираются из своих индексов, а
+    фильмы и персоны, у которых пропали связи, но которые сами остались,
+    переиндексируются.
+    """
+
+    def __init__(self, rows: list):
+        self.log_ids = [row['id'] for row in rows]
+        deleted = defaultdict(set)
+        for row in rows:
+            deleted[row['table_name']].add(row['row_id'])
+        self.deleted = {
+            'movies': deleted['film_work'],
+            'genres': deleted['genre'],
+            'persons': deleted['person'],
+        }
+        self.film_work_ids = {
+            row['film_work_id'] for row in rows
+            if row['table_name'] in ('genre_film_work', 'person_film_work')
+        } - deleted['film_work']
+        self.person_ids = {
+            row['person_id'] for row in rows if row['table_name'] == 'person_film_work'
+        } - deleted['person']
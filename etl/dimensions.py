@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable
+
+import metrics
+
+
+class DimensionCache:
+    """Ограниченный LRU-кэш имен строк справочника по id.
+
+    Жанров и персон немного, и меняются они редко, поэтому имена для
+    обогащения фильмов берутся из памяти, а из Postgres дочитываются
+    только промахи. Проходы по изменениям жанров и персон сбрасывают
+    измененные id.
+    """
+
+    def __init__(self, name: str, maxsize: int = 100000):
+        self.name = name
+        self.maxsize = maxsize
+        self._items: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        # Растет при каждом сбросе: имена, прочитанные до сброса, в кэш не попадут.
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_many(self, ids: Iterable[str], load: Callable[[list[str]], dict[str, str]]) -> dict[str, str]:
+        """Имена по id; промахи читаются одним вызовом load и запоминаются."""
+        found, missing, generation = self._lookup(ids)
+        if missing:
+            loaded = load(missing)
+            self._store(loaded, generation)
+            found.update(loaded)
+        return found
+
+    async def aget_many(
+        self, ids: Iterable[str], load: Callable[[list[str]], Awaitable[dict[str, str]]]
+    ) -> dict[str, str]:
+        """То же, что get_many, для корутины load."""
+        found, missing, generation = self._lookup(ids)
+        if missing:
+            loaded = await load(missing)
+            self._store(loaded, generation)
+            found.update(loaded)
+        return found
+
+    def invalidate(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            self._generation += 1
+            for id_ in ids:
+                self._items.pop(id_, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def _lookup(self, ids: Iterable[str]) -> tuple[dict[str, str], list[str], int]:
+        found, missing = {}, []
+        with self._lock:
+            for id_ in dict.fromkeys(ids):
+                if id_ in self._items:
+                    self._items.move_to_end(id_)
+                    found[id_] = self._items[id_]
+                else:
+                    missing.append(id_)
+            generation = self._generation
+        metrics.dimension_lookups.inc(len(found), dimension=self.name, result='hit')
+        metrics.dimension_lookups.inc(len(missing), dimension=self.name, result='miss')
+        return found, missing, generation
+
+    def _store(self, items: dict[str, str], generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._items.update(items)
+            for id_ in items:
+                self._items.move_to_end(id_)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class FilmDimensions:
+    """Кэши жанров и персон для обогащения фильмов без join в Postgres.
+
+    Из базы читаются только колонки фильма и его связи (genre_ids и пары
+    [person_id, role] в person_roles), а имена подставляются из кэшей.
+    Документ содержит те же жанры и персоны, что собирает запрос с join,
+    но списки отсортированы Python по кодам символов, а не по collation
+    базы, поэтому их порядок может отличаться от array_agg(DISTINCT ...).
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.genres = DimensionCache('genre', maxsize)
+        self.persons = DimensionCache('person', maxsize)
+
+    def invalidate(self, table: str, ids: Iterable[str]) -> None:
+        """Сбросить измененные строки таблицы genre или person."""
+        {'genre': self.genres, 'person': self.persons}[table].invalidate(ids)
+
+    def clear(self) -> None:
+        self.genres.clear()
+        self.persons.clear()
+
+    def enrich(self, rows: list, load_genres, load_persons) -> list[dict]:
+        genres = self.genres.get_many(self._genre_ids(rows), load_genres)
+        persons = self.persons.get_many(self._person_ids(rows), load_persons)
+        return [self.film_work(row, genres, persons) for row in rows]
+
+    async def aenrich(self, rows: list, load_genres, load_persons) -> list[dict]:
+        genres = await self.genres.aget_many(self._genre_ids(rows), load_genres)
+        persons = await self.persons.aget_many(self._person_ids(rows), load_persons)
+        return [self.film_work(row, genres, persons) for row in rows]
+
+    @staticmethod
+    def _genre_ids(rows: list) -> list[str]:
+        return [genre_id for row in rows for genre_id in row['genre_ids']]
+
+    @staticmethod
+    def _person_ids(rows: list) -> list[str]:
+        return [person_id for row in rows for person_id, _ in row['person_roles']]
+
+    @staticmethod
+    def film_work(row, genres: dict[str, str], persons: dict[str, str]) -> dict:
+        """Строка фильма с именами вместо id; порядок имен - сортировка Python."""
+        by_role: dict[str, dict[str, str]] = {'actor': {}, 'writer': {}, 'director': {}}
+        for person_id, role in row['person_roles']:
+            if role in by_role and person_id in persons:
+                by_role[role][person_id] = persons[person_id]
+
+        def names(role: str):
+            return sorted(set(by_role[role].values())) or None
+
+        def people(role: str) -> list[dict]:
+            return sorted(({'id': id_, 'name': name} for id_, name in by_role[role].items()),
+                          key=lambda person: (person['name'], person['id']))
+
+        return {
+            'id': row['id'],
+            'imdb_rating': row['imdb_rating'],
+            'title': row['title'],
+            'description': row['description'],
+            'created': row['created'],
+            'modified': row['modified'],
+            'genre': sorted({genres[id_] for id_ in row['genre_ids'] if id_ in genres}),
+            'actors_names': names('actor'),
+            'writers_names': names('writer'),
+            'director': names('director'),
+            'actors': people('actor'),
+            'writers': people('writer'),
+        }
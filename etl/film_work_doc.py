@@ -0,0 +1,36 @@
+import logging
+
+from psycopg2.extensions import connection as _connection
+
+from postgres_extract import PostgresExtract
+
+FILM_WORK_DOC_DDL = 'schema_design/film_work_doc.ddl'
+
+
+def install_film_work_doc(pg_conn: _connection, batch_size: int = PostgresExtract.LIMIT) -> None:
+    """Создать content.film_work_doc с триггерами и заполнить недостающие документы.
+
+    Документы заполняются пачками по id фильма, каждая пачка в своей
+    транзакции, поэтому прерванное заполнение продолжается с места остановки.
+    """
+    with pg_conn.cursor() as curs:
+        with open(FILM_WORK_DOC_DDL, 'r') as ddl:
+            curs.execute(ddl.read())
+        pg_conn.commit()
+
+        last_id, filled = PostgresExtract.MIN_ID, 0
+        while True:
+            curs.execute(
+                "SELECT fw.id FROM content.film_work fw "
+                "WHERE fw.id > %s AND NOT EXISTS "
+                "(SELECT 1 FROM content.film_work_doc d WHERE d.id = fw.id) "
+                "ORDER BY fw.id LIMIT %s;",
+                (last_id, batch_size),
+            )
+            ids = [row[0] for row in curs.fetchall()]
+            if not ids:
+                break
+            curs.execute("SELECT content.refresh_film_work_doc(%s::uuid[]);", (ids,))
+            pg_conn.commit()
+            last_id, filled = ids[-1], filled + len(ids)
+    logging.info(f'content.film_work_doc is ready, {filled} documents filled')
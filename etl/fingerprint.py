@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Iterable, Union
+
+import orjson
+from pydantic import BaseModel
+
+import metrics
+from load_to_elastic import RawDocument
+
+
+class FingerprintCache:
+    """Кэш отпечатков документов, уже отправленных в Elasticsearch.
+
+    Триггеры обновляют modified при любом UPDATE, даже если данные не
+    поменялись. По стабильному хэшу документа такие повторы отсекаются
+    до bulk-запроса. Отпечатки хранятся в локальном файле SQLite.
+    """
+
+    def __init__(self, file_path: str):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'index_name TEXT NOT NULL, id TEXT NOT NULL, hash TEXT NOT NULL, '
+                'PRIMARY KEY (index_name, id)) WITHOUT ROWID;')
+
+    @staticmethod
+    def fingerprint(doc: Union[BaseModel, RawDocument]) -> str:
+        if isinstance(doc, RawDocument):
+            source = doc.source
+        else:
+            source = orjson.dumps(doc.dict(), option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(source, digest_size=16).hexdigest()
+
+    def filter_changed(self, index: str, docs: list) -> tuple[list, dict[str, str]]:
+        """Оставить документы, отпечаток которых отличается от сохраненного."""
+        hashes = {doc.id: self.fingerprint(doc) for doc in docs}
+        with self._lock:
+            stored = dict(self.conn.execute(
+                f'SELECT id, hash FROM fingerprints WHERE index_name = ? '
+                f'AND id IN ({", ".join("?" * len(hashes))});',
+                (index, *hashes),
+            )) if hashes else {}
+        changed = [doc for doc in docs if stored.get(doc.id) != hashes[doc.id]]
+        if skipped := len(docs) - len(changed):
+            logging.info(f'{index}: skipped {skipped} unchanged documents')
+            metrics.documents.inc(skipped, index=index, result='skipped')
+        return changed, {doc.id: hashes[doc.id] for doc in changed}
+
+    def update(self, index: str, hashes: dict[str, str], failed: Iterable[str] = ()) -> None:
+        """Запомнить отпечатки загруженных документов, кроме неудачных."""
+        failed = set(failed)
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO fingerprints (index_name, id, hash) VALUES (?, ?, ?) '
+                'ON CONFLICT (index_name, id) DO UPDATE SET hash = excluded.hash;',
+                [(index, _id, _hash) for _id, _hash in hashes.items() if _id not in failed],
+            )
+
+    def discard(self, index: str, ids: Iterable[str]) -> None:
+        """Забыть отпечатки удаленных документов."""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM fingerprints WHERE index_name = ? AND id = ?;',
+                [(index, _id) for _id in ids],
+            )
+
+    def move(self, source_index: str, target_index: str) -> None:
+        """Перенести отпечатки на другое имя индекса, заменив его старые."""
+        with self._lock, self.conn:
+            self.conn.execute('DELETE FROM fingerprints WHERE index_name = ?;', (target_index,))
+            self.conn.execute(
+                'UPDATE fingerprints SET index_name = ? WHERE index_name = ?;',
+                (target_index, source_index))
@@ -52,6 +52,12 @@ persons_index = {
        "full_name": {
           "type": "text",
           "analyzer": "ru_en"
+       },
+       "film_ids": {
+          "type": "keyword"
+       },
+       "roles": {
+          "type": "keyword"
        }
       }
    }
@@ -0,0 +1,119 @@
+import logging
+import select
+import time
+from collections import defaultdict
+from typing import Optional
+
+import backoff
+import orjson
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import connection as _connection
+
+import metrics
+
+LISTEN_DDL = 'schema_design/listen.ddl'
+
+
+def install_listen(pg_conn: _connection, channel: str = 'content_changes') -> None:
+    """Создать триггеры, которые сообщают об изменениях схемы content в канал channel."""
+    with pg_conn.cursor() as curs:
+        with open(LISTEN_DDL, 'r') as ddl:
+            curs.execute(sql.SQL(ddl.read()).format(channel=sql.Literal(channel)))
+        pg_conn.commit()
+
+
+class ChangeBatch:
+    """Накопленные из уведомлений id измененных строк по таблицам."""
+
+    def __init__(self):
+        self.ids: dict[str, set[str]] = defaultdict(set)
+        self.film_work_ids: set[str] = set()
+        self.person_ids: set[str] = set()
+        self.count = 0
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, payload: dict) -> None:
+        """Учесть одно уведомление триггера notify_content_change."""
+        table = payload['table']
+        self.ids[table].add(payload['id'])
+        if film_work_id := payload.get('film_work_id'):
+            self.film_work_ids.add(film_work_id)
+        if person_id := payload.get('person_id'):
+            self.person_ids.add(person_id)
+        self.count += 1
+
+
+class ChangeListener:
+    """Слушает канал LISTEN/NOTIFY и собирает уведомления в пачки.
+
+    После первого уведомления слушатель ждет, пока поток изменений не
+    затихнет на debounce секунд, но не дольше max_wait и не больше
+    max_batch уведомлений, и отдает накопленное одной пачкой.
+    """
+
+    def __init__(self, dsl: dict, channel: str = 'content_changes',
+                 debounce: float = 0.2, max_wait: float = 1.0, max_batch: int = 500):
+        self.dsl = dsl
+        self.channel = channel
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.conn = None
+
+    @backoff.on_exception(
+        backoff.expo,
+        psycopg2.OperationalError,
+        max_tries=50,
+        on_backoff=metrics.on_backoff,
+    )
+    def connect(self) -> None:
+        self.close()
+        self.conn = psycopg2.connect(**self.dsl)
+        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.conn.cursor() as curs:
+            curs.execute(f'LISTEN {self.channel};')
+        logging.info(f'Listening channel {self.channel}')
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    def wait_changes(self, timeout: float) -> Optional[ChangeBatch]:
+        """Дождаться пачки изменений не дольше timeout секунд."""
+        if self.conn is None or self.conn.closed:
+            self.connect()
+        batch = ChangeBatch()
+        try:
+            if not self._poll(batch, timeout):
+                return None
+            started = time.monotonic()
+            while len(batch) < self.max_batch:
+                left = self.max_wait - (time.monotonic() - started)
+                if left <= 0 or not self._poll(batch, min(self.debounce, left)):
+                    break
+        except psycopg2.OperationalError:
+            logging.error('Listener connection lost')
+            self.close()
+        return batch or None
+
+    def _poll(self, batch: ChangeBatch, timeout: float) -> bool:
+        """Дочитать уведомления из соединения, вернуть True если они были."""
+        if not self.conn.notifies and select.select([self.conn], [], [], timeout) == ([], [], []):
+            return False
+        self.conn.poll()
+        received = bool(self.conn.notifies)
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            try:
+                batch.add(orjson.loads(notify.payload))
+            except (orjson.JSONDecodeError, KeyError):
+                logging.error(f'Bad notification payload: {notify.payload}')
+        return received
@@ -1,36 +1,316 @@
+import asyncio
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterable, Iterator, NamedTuple
 
 import backoff
 from dotenv import dotenv_values
 from elastic_transport import ConnectionError
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+import orjson
+from pydantic import BaseModel
 
-from schemas import FilmworkSchemaOut
+import metrics
 
 config = dotenv_values("../enviroments/.env")
 
+TOO_MANY_REQUESTS = 429
+
+
+@dataclass
+class BulkReport:
+    """Поэлементный итог загрузки пачки в Elasticsearch."""
+
+    success: int = 0
+    retried: int = 0
+    errors: list[dict] = field(default_factory=list)
+    # Размер ndjson-тела пачки без учета повторов.
+    bytes: int = 0
+    # Отправлено байт ndjson вместе с повторами, до сжатия http_compress.
+    sent_bytes: int = 0
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+
+class RawDocument(NamedTuple):
+    """Документ, уже сериализованный в json."""
+
+    id: str
+    source: bytes
+
 
 class LoadElastic:
-    """Класс реализует метод загрузки данных в Elasticsearch."""
+    """Класс реализует метод загрузки данных в Elasticsearch.
+
+    Действия bulk сериализуются orjson в строки ndjson один раз и
+    отправляются готовыми байтами, а с http_compress тело запроса
+    сжимается gzip.
+    """
+
+    def __init__(
+        self,
+        es_host: str,
+        es_user: str,
+        es_password: str,
+        bulk_mode: str = 'streaming',
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 100 * 1024 * 1024,
+        thread_count: int = 4,
+        max_retries: int = 5,
+        initial_backoff: float = 2,
+        max_backoff: float = 60,
+        payload_log_rate: float = 0.0,
+        connections_per_node: int = 10,
+        http_compress: bool = True,
+    ):
+        self.es = self._create_client(es_host, es_user, es_password, connections_per_node, http_compress)
+        self.bulk_mode = bulk_mode
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.payload_log_rate = payload_log_rate
 
-    def __init__(self, es_host: str, es_user: str, es_password: str):
-        self.es = Elasticsearch(
+    @staticmethod
+    def _create_client(es_host: str, es_user: str, es_password: str, connections_per_node: int,
+                       http_compress: bool) -> Elasticsearch:
+        return Elasticsearch(
             es_host, basic_auth=(es_user, es_password),
-            verify_certs=False
+            verify_certs=False, connections_per_node=connections_per_node,
+            http_compress=http_compress,
         )
 
-    @staticmethod
     @backoff.on_exception(
         backoff.expo,
         ConnectionError,
         max_tries=10,
+        on_backoff=metrics.on_backoff,
+    )
+    def send_data_to_es(self, es_data: list[BaseModel], index: str) -> BulkReport:
+        """Загрузить документы в индекс.
+
+        Повторно отправляются только документы, отклоненные с 429,
+        остальные ошибки попадают в отчет без повторов.
+        """
+        report = self._send_with_retries(index, self._actions(es_data, index))
+        self._log_payload(index, es_data)
+        self._log_report(index, report)
+        return report
+
+    @backoff.on_exception(
+        backoff.expo,
+        ConnectionError,
+        max_tries=10,
+        on_backoff=metrics.on_backoff,
     )
-    def send_data_to_es(es: Elasticsearch, es_data: list[FilmworkSchemaOut], index: str) -> tuple[int, list]:
-        query = [{'_index': index, '_id': data.id, '_source': data.dict()}
-                 for data in es_data]
-        rows_count, errors = helpers.bulk(es, query)
-        if errors:
+    def send_raw_to_es(self, docs: list[RawDocument], index: str) -> BulkReport:
+        """Загрузить в индекс готовые json-документы без их разбора."""
+        report = self._send_with_retries(index, self._raw_actions(docs, index))
+        self._log_report(index, report)
+        return report
+
+    @backoff.on_exception(
+        backoff.expo,
+        ConnectionError,
+        max_tries=10,
+        on_backoff=metrics.on_backoff,
+    )
+    def delete_from_es(self, ids: Iterable[str], index: str) -> BulkReport:
+        """Удалить документы из индекса, отсутствующие документы не считаются ошибкой."""
+        report = self._send_with_retries(index, self._delete_actions(ids, index))
+        self._log_report(index, report, result='deleted')
+        return report
+
+    @classmethod
+    def _actions(cls, es_data: list[BaseModel], index: str) -> dict[str, bytes]:
+        """Строки ndjson для моделей: документ сериализуется orjson за один проход."""
+        return {data.id: cls._index_action(index, data.id, orjson.dumps(data.dict())) for data in es_data}
+
+    @classmethod
+    def _raw_actions(cls, docs: list[RawDocument], index: str) -> dict[str, bytes]:
+        return {doc.id: cls._index_action(index, doc.id, doc.source) for doc in docs}
+
+    @staticmethod
+    def _index_action(index: str, _id: str, source: bytes) -> bytes:
+        return orjson.dumps({'index': {'_index': index, '_id': _id}}) + b'\n' + source + b'\n'
+
+    def _send_with_retries(self, index: str, actions: dict[str, bytes]) -> BulkReport:
+        """Отправить действия, повторяя только отклоненные с 429."""
+        report = BulkReport(bytes=sum(map(len, actions.values())))
+        pending = list(actions)
+
+        for attempt in range(self.max_retries + 1):
+            rejected = []
+            report.sent_bytes += sum(len(actions[_id]) for _id in pending)
+            for ok, item in self._bulk(actions[_id] for _id in pending):
+                self._account(report, rejected, index, ok, item, retry=attempt < self.max_retries)
+            if not rejected:
+                break
+            report.retried += len(rejected)
+            pending = rejected
+            time.sleep(self._retry_delay(attempt))
+        return report
+
+    @staticmethod
+    def _account(report: BulkReport, rejected: list, index: str, ok: bool, item: dict, retry: bool) -> None:
+        """Учесть результат одного документа; отклоненные с 429 попадают в rejected."""
+        info = next(iter(item.values()))
+        if ok:
+            report.success += 1
+            return
+        metrics.es_rejections.inc(index=index, status=str(info.get('status')))
+        if info.get('status') == TOO_MANY_REQUESTS and retry:
+            rejected.append(info['_id'])
+        else:
+            report.errors.append(info)
+
+    def _retry_delay(self, attempt: int) -> float:
+        return min(self.initial_backoff * 2 ** attempt, self.max_backoff)
+
+    def _log_payload(self, index: str, es_data: list[BaseModel]) -> None:
+        if self.payload_log_rate and random.random() < self.payload_log_rate:
+            logging.debug(f'Данные в индекса {index} Обновились. Данные: {es_data}.')
+
+    @staticmethod
+    def _delete_actions(ids: Iterable[str], index: str) -> dict:
+        return {_id: orjson.dumps({'delete': {'_index': index, '_id': _id}}) + b'\n' for _id in ids}
+
+    @staticmethod
+    def _item_ok(item: dict) -> bool:
+        """Успех элемента bulk; удаление отсутствующего документа тоже успех."""
+        (operation, info), = item.items()
+        status = info.get('status', 500)
+        return 200 <= status < 300 or (operation == 'delete' and status == 404)
+
+    @staticmethod
+    def _log_report(index: str, report: BulkReport, result: str = 'indexed') -> None:
+        if report.errors:
             logging.error('Error while save data in Elasticsearch',
-                          extra={'query': query, 'errors': errors})
-        logging.info(f'Данные в индекса {index} Обновились. Данные: {es_data}.')
-        return rows_count, errors
+                          extra={'errors': report.errors})
+        logging.info(f'{index}: success={report.success} retried={report.retried} '
+                     f'failed={report.failed} bytes={report.sent_bytes}')
+        metrics.bulk_bytes.inc(report.sent_bytes, index=index)
+        metrics.documents.inc(report.success, index=index, result=result)
+        metrics.documents.inc(report.retried, index=index, result='retried')
+        metrics.documents.inc(report.failed, index=index, result='failed')
+
+    def _bulk(self, actions: Iterable[bytes]) -> Iterator[tuple[bool, dict]]:
+        """Отправить ndjson-строки пачками по chunk_size и max_chunk_bytes.
+
+        В режиме parallel части пачки уходят одновременно из thread_count потоков.
+        """
+        def send(chunk: list[bytes]) -> list[dict]:
+            return self.es.bulk(operations=b''.join(chunk))['items']
+
+        chunks = self._chunk_raw(actions)
+        if self.bulk_mode == 'parallel':
+            with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+                responses = list(executor.map(send, chunks))
+        else:
+            responses = map(send, chunks)
+        for items in responses:
+            for item in items:
+                yield self._item_ok(item), item
+
+    def _chunk_raw(self, actions: Iterable[bytes]) -> Iterator[list[bytes]]:
+        chunk, size = [], 0
+        for action in actions:
+            if chunk and (len(chunk) >= self.chunk_size or size + len(action) > self.max_chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(action)
+            size += len(action)
+        if chunk:
+            yield chunk
+
+
+class AsyncLoadElastic(LoadElastic):
+    """Загрузка в Elasticsearch через AsyncElasticsearch.
+
+    Один клиент держит пул keep-alive соединений, а bulk-запросы не
+    блокируют цикл событий, поэтому несколько пачек могут загружаться
+    одновременно.
+    """
+
+    @staticmethod
+    def _create_client(es_host: str, es_user: str, es_password: str, connections_per_node: int,
+                       http_compress: bool) -> AsyncElasticsearch:
+        return AsyncElasticsearch(
+            es_host, basic_auth=(es_user, es_password),
+            verify_certs=False, connections_per_node=connections_per_node,
+            http_compress=http_compress,
+        )
+
+    async def close(self) -> None:
+        await self.es.close()
+
+    @backoff.on_exception(
+        backoff.expo,
+        ConnectionError,
+        max_tries=10,
+        on_backoff=metrics.on_backoff,
+    )
+    async def send_data_to_es(self, es_data: list[BaseModel], index: str) -> BulkReport:
+        report = await self._send_with_retries(index, self._actions(es_data, index))
+        self._log_payload(index, es_data)
+        self._log_report(index, report)
+        return report
+
+    @backoff.on_exception(
+        backoff.expo,
+        ConnectionError,
+        max_tries=10,
+        on_backoff=metrics.on_backoff,
+    )
+    async def send_raw_to_es(self, docs: list[RawDocument], index: str) -> BulkReport:
+        report = await self._send_with_retries(index, self._raw_actions(docs, index))
+        self._log_report(index, report)
+        return report
+
+    @backoff.on_exception(
+        backoff.expo,
+        ConnectionError,
+        max_tries=10,
+        on_backoff=metrics.on_backoff,
+    )
+    async def delete_from_es(self, ids: Iterable[str], index: str) -> BulkReport:
+        report = await self._send_with_retries(index, self._delete_actions(ids, index))
+        self._log_report(index, report, result='deleted')
+        return report
+
+    async def _send_with_retries(self, index: str, actions: dict[str, bytes]) -> BulkReport:
+        report = BulkReport(bytes=sum(map(len, actions.values())))
+        pending = list(actions)
+
+        for attempt in range(self.max_retries + 1):
+            rejected = []
+            report.sent_bytes += sum(len(actions[_id]) for _id in pending)
+            async for ok, item in self._bulk(actions[_id] for _id in pending):
+                self._account(report, rejected, index, ok, item, retry=attempt < self.max_retries)
+            if not rejected:
+                break
+            report.retried += len(rejected)
+            pending = rejected
+            await asyncio.sleep(self._retry_delay(attempt))
+        return report
+
+    async def _bulk(self, actions: Iterable[bytes]) -> AsyncIterator[tuple[bool, dict]]:
+        """Отправить ndjson-строки; в режиме parallel части пачки уходят одновременно."""
+        async def send(chunk: list[bytes]) -> list[dict]:
+            return (await self.es.bulk(operations=b''.join(chunk)))['items']
+
+        chunks = list(self._chunk_raw(actions))
+        if self.bulk_mode == 'parallel':
+            responses = await asyncio.gather(*map(send, chunks))
+        else:
+            responses = [await send(chunk) for chunk in chunks]
+        for items in responses:
+            for item in items:
+                yield self._item_ok(item), item
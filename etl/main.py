@@ -1,112 +1,466 @@
+import argparse
+import asyncio
 import logging
-import sqlite3
+import os
+import sys
 import time
+from functools import wraps
+from typing import Callable, Optional
 
 import backoff
 from elastic_transport import ConnectionError
 import psycopg2
 from dotenv import dotenv_values
-from psycopg2.extras import DictCursor
 
+import metrics
+from async_etl import AsyncRuntime
+from batching import AdaptiveBatchSize
+from changeset import ChangeSet, Tombstones, chunked
 from config import dsl
-from sqlite_to_postgres import load_from_sqlite
+from dimensions import FilmDimensions
+from sqlite_to_postgres import CopyPostgresSaver, PostgresSaver, migrate_from_sqlite
 from indexes import index_to_schema
+from film_work_doc import install_film_work_doc
+from fingerprint import FingerprintCache
+from listener import ChangeBatch, ChangeListener, install_listen
 from load_to_elastic import LoadElastic
+from pipeline import Pipeline
 from postgres_extract import PostgresExtract
-from schemas import ElasticSettings, FilmworkSchemaOut, GenreSchemaOut, PersonSchemaOut
-from state import JsonFileStorage, State
+from reindex import full_reindex
+from replication import ReplicationBatch, ReplicationSource, format_lsn, install_replication
+from resources import Resources
+from sharding import Shard
+from spool import SpoolError, SpoolReplayer, SpoolWriter
+from schemas import ElasticSettings, EtlSettings, FilmworkSchemaOut, GenreSchemaOut, PersonSchemaOut
+from transform import raw_transform
+from state import (AtomicJsonFileStorage, BaseStorage, MemoryStorage, NamespacedStorage,
+                   PostgresStorage, SQLiteStorage, State, load_cursor, save_cursor)
+from workers import Supervisor
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
 
+etl_settings = EtlSettings()
+fingerprints = FingerprintCache(etl_settings.fingerprint_path) if etl_settings.fingerprint_path else None
+resources = Resources(dsl, pool_size=etl_settings.pg_pool_size,
+                      health_check_interval=etl_settings.health_check_interval)
+batch_sizes: dict[str, AdaptiveBatchSize] = {}
+dimensions = (FilmDimensions(etl_settings.dimension_cache_size)
+              if etl_settings.enrichment == 'cache' else None)
+
+
+def adaptive_batch(index: str) -> Optional[AdaptiveBatchSize]:
+    """Регулятор размера пачек индекса, общий для всех циклов процесса."""
+    if not etl_settings.adaptive_batch:
+        return None
+    if index not in batch_sizes:
+        batch_sizes[index] = AdaptiveBatchSize(
+            index,
+            initial=PostgresExtract.LIMIT,
+            minimum=etl_settings.batch_min_size,
+            maximum=etl_settings.batch_max_size,
+            target_bytes=int(etl_settings.batch_target_mb * 1024 * 1024),
+            target_latency=etl_settings.batch_target_latency,
+        )
+    return batch_sizes[index]
+
+
+def invalidate_dimensions(table: str, ids) -> None:
+    """Сбросить в кэше обогащения измененные жанры или персоны."""
+    if dimensions is not None:
+        dimensions.invalidate(table, ids)
+
+
+def invalidating_source(source, table: str):
+    """Пропустить пачки строк жанров или персон, сбрасывая их в кэше обогащения."""
+    for cursor, rows in source:
+        invalidate_dimensions(table, [row['id'] for row in rows])
+        yield cursor, rows
+
 
 def connect_to_database(process_etl_func):
-    def wrapper(elastic_conn, state, pg_conn=None):
+    @wraps(process_etl_func)
+    def wrapper(elastic_conn, state, pg_conn=None, **kwargs):
         try:
-            with psycopg2.connect(**dsl, cursor_factory=DictCursor) as pg_conn:
-                process_etl_func(elastic_conn, state, pg_conn)
+            with resources.pg_connection() as pg_conn:
+                process_etl_func(elastic_conn, state, pg_conn, **kwargs)
         except psycopg2.OperationalError:
             logging.error('Connection refused')
     return wrapper
 
 
+def run_pipeline(elastic_database: Optional[LoadElastic], source, schema, index: str, checkpoint,
+                 raw: bool = False, spool: Optional[SpoolWriter] = None) -> None:
+    """Прогнать пачки строк из источника через конвейер transform -> load.
+
+    С raw источник отдает готовые json-документы, которые уходят в bulk
+    без построения моделей. Со spool пачки пишутся в его сегменты, и
+    elastic_database не нужен.
+    """
+    if spool is not None:
+        def load(docs):
+            spool.write(index, docs)
+    else:
+        load = elastic_loader(elastic_database, index, raw)
+
+    Pipeline(
+        transform=(raw_transform(schema, etl_settings.validate_every) if raw
+                   else lambda rows: [schema(**row) for row in rows]),
+        load=load,
+        checkpoint=checkpoint,
+        transform_workers=etl_settings.transform_workers,
+        load_workers=etl_settings.load_workers,
+        queue_size=etl_settings.queue_size,
+        name=index,
+    ).run(source)
+
+
+def elastic_loader(elastic_database: LoadElastic, index: str, raw: bool) -> Callable[[list], None]:
+    """Функция загрузки пачки в индекс с пропуском неизмененных документов."""
+    send = elastic_database.send_raw_to_es if raw else elastic_database.send_data_to_es
+    batch = adaptive_batch(index)
+
+    def load(docs):
+        if fingerprints is not None:
+            docs, hashes = fingerprints.filter_changed(index, docs)
+        if docs:
+            started = time.perf_counter()
+            report = send(docs, index)
+            if batch is not None:
+                batch.observe(len(docs), time.perf_counter() - started, report.bytes, report.retried)
+            if fingerprints is not None:
+                fingerprints.update(index, hashes, failed=(error.get('_id') for error in report.errors))
+
+    return load
+
+
+def extract_film_works(postgres_extract: PostgresExtract, ids_film_work: list[str], cursors: dict,
+                       raw: bool = False):
+    """Отдать пачки данных фильмов по id.
+
+    Курсоры таблиц отдаются отдельной пустой пачкой после всех фильмов,
+    чтобы состояние сдвигалось только после их загрузки. С raw отдаются
+    готовые json-документы. С ETL_ENRICHMENT=cache из базы читаются только
+    фильмы и их связи, а имена жанров и персон берутся из кэша.
+    """
+    if not raw and dimensions is not None:
+        def extract(ids):
+            for rows in postgres_extract.get_film_work_links(ids):
+                yield dimensions.enrich(
+                    rows, postgres_extract.get_genre_names, postgres_extract.get_person_names)
+    elif not raw:
+        extract = postgres_extract.get_all_data_film_work
+    elif etl_settings.film_work_doc:
+        extract = postgres_extract.get_film_work_documents_from_table
+    else:
+        extract = postgres_extract.get_film_work_documents
+    for ids in chunked(ids_film_work, postgres_extract.page_size):
+        for data in extract(ids):
+            yield None, data
+    yield cursors, []
+
+
+def index_change_set(postgres_extract: PostgresExtract, elastic_database: Optional[LoadElastic],
+                     change_set: ChangeSet, state, index: str, spool: Optional[SpoolWriter] = None) -> None:
+    """Проиндексировать накопленные фильмы и сохранить курсоры таблиц."""
+    ids_film_work, cursors = change_set.flush()
+
+    def checkpoint(cursors):
+        for table, cursor in cursors.items():
+            save_cursor(state, table, cursor)
+
+    raw = etl_settings.transform_mode == 'raw'
+    run_pipeline(
+        elastic_database,
+        extract_film_works(postgres_extract, ids_film_work, cursors, raw=raw),
+        FilmworkSchemaOut, index, checkpoint, raw=raw, spool=spool,
+    )
+
+
 @connect_to_database
-def process_etl_movies(elastic_conn, state, pg_conn=None):
-    """Загрузка данных по фильмам в elasticsearch."""
-    postgres_extract = PostgresExtract(pg_conn=pg_conn)
-    elastic_database = LoadElastic(**elastic_conn)
-    tables = ('film_work', 'genre', 'person')
+def process_etl_movies(elastic_conn, state, pg_conn=None, index='movies', shard: Optional[Shard] = None,
+                       spool: Optional[SpoolWriter] = None):
+    """Загрузка данных по фильмам в elasticsearch.
+
+    Id фильмов из изменений в film_work, genre и person собираются в один
+    набор без повторов, который индексируется частями по
+    ETL_CHANGESET_MAX_IDS фильмов. С shard обрабатываются только фильмы
+    этого шарда. С content.film_work_doc достаточно одного прохода по нему:
+    триггеры обновляют документ при любом изменении фильма, его связей,
+    жанров и персон. Со spool документы пишутся в сегменты, а не в
+    Elasticsearch.
+    """
+    postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize, shard=shard,
+                                       batch=adaptive_batch(index))
+    elastic_database = resources.load_elastic(elastic_conn) if spool is None else None
+    tables = ('film_work_doc',) if etl_settings.film_work_doc else ('film_work', 'genre', 'person')
+    change_set = ChangeSet()
 
     for table in tables:
-        key_state = f'{table}_modified'
-        last_modified_state = state.get_state(key_state)
-        offset = 0
-
-        while True:
-            logging.info('Read data from postgres')
-            last_modified, ids_modified = postgres_extract.get_ids_modified_data(
-                table, last_modified_state, offset)
-            offset += postgres_extract.LIMIT
-            if not ids_modified:
-                logging.info('Обновленных данных по фильмам нет.')
-                break
-            ids_film_work = postgres_extract.get_ids_data_modified(
-                table, ids_modified)
-            data = postgres_extract.get_all_data_film_work(
-                ids_film_work)
-            film_works_to_elastic = [
-                FilmworkSchemaOut(**item) for item in data]
-            elastic_database.send_data_to_es(
-                elastic_database.es, film_works_to_elastic, 'movies')
-            state.set_state(key_state, last_modified.isoformat())
+        logging.info(f'Read data from postgres ({table})')
+        pages = postgres_extract.iter_ids_modified_data(
+            table, *load_cursor(state, table))
+        for cursor, ids_modified in pages:
+            if table in ('genre', 'person'):
+                invalidate_dimensions(table, ids_modified)
+            change_set.add(
+                table, postgres_extract.get_ids_data_modified(table, ids_modified), cursor)
+            if len(change_set) >= etl_settings.changeset_max_ids:
+                index_change_set(postgres_extract, elastic_database, change_set, state, index, spool)
+
+    if change_set.cursors:
+        index_change_set(postgres_extract, elastic_database, change_set, state, index, spool)
+    if not change_set.indexed:
+        logging.info('Обновленных данных по фильмам нет.')
+    change_set.log_stats()
 
 
 @connect_to_database
-def process_etl_genres(elastic_conn, state, pg_conn=None):
-    """Загрузка данных по жанрам в elasticsearch."""
-    postgres_extract = PostgresExtract(pg_conn=pg_conn)
-    elastic_database = LoadElastic(**elastic_conn)
+def process_etl_genres(elastic_conn, state, pg_conn=None, index='genres',
+                       spool: Optional[SpoolWriter] = None):
+    """Загрузка данных по жанрам в elasticsearch или в сегменты spool."""
+    postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize,
+                                       batch=adaptive_batch(index))
+    elastic_database = resources.load_elastic(elastic_conn) if spool is None else None
     key_state = 'genres_table'
-    last_modified_state = state.get_state(key_state)
-    last_modified_genres, genres = postgres_extract.get_modified_genres(last_modified_state)
-    if not genres:
-        logging.info('Обновленных данных по жанрам нет.')
-        return
-    genres_to_elastic = [GenreSchemaOut(**genre) for genre in genres]
-    elastic_database.send_data_to_es(
-        elastic_database.es, genres_to_elastic, 'genres')
-    state.set_state(key_state, last_modified_genres.isoformat())
+    run_pipeline(
+        elastic_database,
+        invalidating_source(
+            postgres_extract.iter_modified_genres(*load_cursor(state, key_state)), 'genre'),
+        GenreSchemaOut, index,
+        lambda cursor: save_cursor(state, key_state, cursor), spool=spool,
+    )
+    logging.info('Обновленных данных по жанрам больше нет.')
+
+
+def extract_persons_by_new_links(postgres_extract: PostgresExtract, cursor: tuple):
+    """Отдать пачки персон, у которых появились новые связи с фильмами.
+
+    Курсор страницы связей отдается пустой пачкой после ее персон.
+    """
+    for page_cursor, ids_person in postgres_extract.iter_person_ids_by_new_links(*cursor):
+        for data in postgres_extract.get_persons_by_ids(ids_person):
+            yield None, data
+        yield page_cursor, []
 
 
 @connect_to_database
-def process_etl_persons(elastic_conn, state, pg_conn=None):
-    """Загрузка данных по персонам в elasticsearch."""
-    postgres_extract = PostgresExtract(pg_conn=pg_conn)
-    elastic_database = LoadElastic(**elastic_conn)
-    key_state = 'persons_table'
-    last_modified_state = state.get_state(key_state)
-    last_modified_persons, persons = postgres_extract.get_modified_persons(last_modified_state)
-    if not persons:
-        logging.info('Обновленных данных по персонам нет.')
-        return
-    persons_to_elastic = [PersonSchemaOut(**person) for person in persons]
-    elastic_database.send_data_to_es(
-        elastic_database.es, persons_to_elastic, 'persons')
-    state.set_state(key_state, last_modified_persons.isoformat())
+def process_etl_persons(elastic_conn, state, pg_conn=None, index='persons',
+                        spool: Optional[SpoolWriter] = None):
+    """Загрузка данных по персонам в elasticsearch.
+
+    Вместе с персоной загружаются id ее фильмов и роли. Кроме измененных
+    персон пересчитываются только те, у которых появились новые связи
+    с фильмами. Со spool документы пишутся в сегменты.
+    """
+    postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize,
+                                       batch=adaptive_batch(index))
+    elastic_database = resources.load_elastic(elastic_conn) if spool is None else None
+    key_state, key_links = 'persons_table', 'person_film_work'
+    run_pipeline(
+        elastic_database,
+        invalidating_source(
+            postgres_extract.iter_modified_persons(*load_cursor(state, key_state)), 'person'),
+        PersonSchemaOut, index,
+        lambda cursor: save_cursor(state, key_state, cursor), spool=spool,
+    )
+    run_pipeline(
+        elastic_database,
+        extract_persons_by_new_links(postgres_extract, load_cursor(state, key_links)),
+        PersonSchemaOut, index,
+        lambda cursor: save_cursor(state, key_links, cursor), spool=spool,
+    )
+    logging.info('Обновленных данных по персонам больше нет.')
+
+
+@connect_to_database
+def process_etl_changes(elastic_conn, state, pg_conn=None, changes: ChangeBatch = None):
+    """Загрузка в elasticsearch изменений, пришедших через LISTEN/NOTIFY.
+
+    Курсоры состояния не сдвигаются: их продвигает периодический проход,
+    который подстраховывает потерянные уведомления.
+    """
+    postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize,
+                                       batch=adaptive_batch('movies'))
+    elastic_database = resources.load_elastic(elastic_conn)
+    genre_ids, person_ids = changes.ids['genre'], changes.ids['person']
+    invalidate_dimensions('genre', genre_ids)
+    invalidate_dimensions('person', person_ids)
+    change_set = ChangeSet()
+    change_set.add('film_work', changes.ids['film_work'])
+    change_set.add('links', changes.film_work_ids)
+    for ids in chunked(genre_ids, postgres_extract.page_size):
+        change_set.add('genre', postgres_extract.get_ids_film_work_by_genre(ids))
+    for ids in chunked(person_ids, postgres_extract.page_size):
+        change_set.add('person', postgres_extract.get_ids_film_work_by_person(ids))
+    logging.info(f'Notified changes: {len(changes)}, films to update: {len(change_set)}')
+    index_change_set(postgres_extract, elastic_database, change_set, state, 'movies')
+    change_set.log_stats()
+
+    passes = (
+        (genre_ids, postgres_extract.get_genres_by_ids, GenreSchemaOut, 'genres'),
+        (person_ids | changes.person_ids, postgres_extract.get_persons_by_ids, PersonSchemaOut, 'persons'),
+    )
+    for ids, extract, schema, index in passes:
+        source = (
+            (None, rows)
+            for chunk in chunked(ids, postgres_extract.page_size)
+            for rows in extract(chunk)
+        )
+        run_pipeline(elastic_database, source, schema, index, lambda _: None)
+
+
+@connect_to_database
+def process_etl_deletions(elastic_conn, state, pg_conn=None):
+    """Перенос удалений из журнала content.deleted_rows в elasticsearch.
+
+    Удаленные фильмы, жанры и персоны удаляются из индексов, фильмы и
+    персоны, у которых пропали связи, переиндексируются. Строки журнала
+    удаляются только после загрузки, поэтому при ошибке страница будет
+    обработана повторно.
+    """
+    postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize,
+                                       batch=adaptive_batch('movies'))
+    elastic_database = resources.load_elastic(elastic_conn)
+    while rows := postgres_extract.get_deleted_rows():
+        tombstones = Tombstones(rows)
+        apply_tombstones(postgres_extract, elastic_database, tombstones, state)
+        postgres_extract.remove_deleted_rows(tombstones.log_ids)
+        logging.info(f'Deletions applied: {len(tombstones.log_ids)} log rows')
+
+
+def apply_tombstones(postgres_extract: PostgresExtract, elastic_database: LoadElastic,
+                     tombstones: Tombstones, state) -> None:
+    """Удалить из индексов удаленные строки и переиндексировать потерявших связи."""
+    invalidate_dimensions('genre', tombstones.deleted['genres'])
+    invalidate_dimensions('person', tombstones.deleted['persons'])
+    for index, ids in tombstones.deleted.items():
+        if not ids:
+            continue
+        elastic_database.delete_from_es(ids, index)
+        if fingerprints is not None:
+            fingerprints.discard(index, ids)
+
+    change_set = ChangeSet()
+    change_set.add('links', tombstones.film_work_ids)
+    index_change_set(postgres_extract, elastic_database, change_set, state, 'movies')
+    source = (
+        (None, data)
+        for chunk in chunked(tombstones.person_ids, postgres_extract.page_size)
+        for data in postgres_extract.get_persons_by_ids(chunk)
+    )
+    run_pipeline(elastic_database, source, PersonSchemaOut, 'persons', lambda _: None)
+
+
+def run_polling_sweep(elastic_conn, state, shard: Optional[Shard] = None) -> None:
+    """Проход по всем таблицам по курсорам modified.
+
+    Индексы жанров и персон невелики, их при работе воркерами загружает
+    только нулевой шард, он же переносит удаления. Удаления идут первыми,
+    чтобы фильм, созданный заново после удаления, остался в индексе.
+    """
+    if shard is None or shard.index == 0:
+        process_etl_deletions(elastic_conn, state)
+    process_etl_movies(elastic_conn, state, shard=shard)
+    if shard is None or shard.index == 0:
+        process_etl_genres(elastic_conn, state)
+        process_etl_persons(elastic_conn, state)
+    state.flush()
+
+
+def listen_changes(elastic_conn, state) -> None:
+    """Событийный режим: загрузка по уведомлениям с периодическим проходом."""
+    listener = ChangeListener(
+        dsl, channel=etl_settings.listen_channel,
+        debounce=etl_settings.listen_debounce,
+        max_wait=etl_settings.listen_max_wait,
+        max_batch=PostgresExtract.LIMIT,
+    )
+    # LISTEN до первого прохода, чтобы не потерять изменения между ними.
+    listener.connect()
+    next_sweep = 0.0
+    while True:
+        if time.monotonic() >= next_sweep:
+            run_polling_sweep(elastic_conn, state)
+            next_sweep = time.monotonic() + etl_settings.sweep_interval
+        changes = listener.wait_changes(timeout=max(next_sweep - time.monotonic(), 0))
+        if changes:
+            process_etl_deletions(elastic_conn, state)
+            process_etl_changes(elastic_conn, state, changes=changes)
+
+
+def apply_replicated_changes(elastic_conn, state, changes: ReplicationBatch) -> bool:
+    """Загрузить пачку из слота репликации, вернуть True если она загружена.
+
+    В отличие от connect_to_database ошибка соединения не глушится молча:
+    по False позиция пачки не подтверждается и она будет прочитана заново.
+    """
+    try:
+        with resources.pg_connection() as pg_conn:
+            if changes.deleted_rows:
+                postgres_extract = PostgresExtract(pg_conn=pg_conn, itersize=etl_settings.itersize,
+                                                   batch=adaptive_batch('movies'))
+                apply_tombstones(postgres_extract, resources.load_elastic(elastic_conn),
+                                 Tombstones(changes.deleted_rows), state)
+            if changes.ids or changes.film_work_ids or changes.person_ids:
+                process_etl_changes.__wrapped__(elastic_conn, state, pg_conn, changes=changes)
+    except psycopg2.OperationalError:
+        logging.error('Connection refused')
+        return False
+    return True
+
+
+def replicate_changes(elastic_conn, state) -> None:
+    """Загрузка изменений из слота логической репликации.
+
+    Подтвержденный LSN хранится в состоянии и сообщается серверу только
+    после загрузки пачки. Слот создается до первого прохода, поэтому
+    изменения между ними не теряются; дальше проход по modified
+    выполняется раз в ETL_SWEEP_INTERVAL секунд как страховка и для
+    очистки журнала удалений.
+    """
+    source = ReplicationSource(
+        dsl, slot=etl_settings.replication_slot,
+        plugin=etl_settings.replication_plugin,
+        publication=etl_settings.replication_publication,
+        debounce=etl_settings.listen_debounce,
+        max_wait=etl_settings.listen_max_wait,
+        max_batch=PostgresExtract.LIMIT,
+    )
+    source.connect(state.get_state('replication_lsn'))
+    next_sweep = 0.0
+    while True:
+        if time.monotonic() >= next_sweep:
+            run_polling_sweep(elastic_conn, state)
+            next_sweep = time.monotonic() + etl_settings.sweep_interval
+        changes = source.wait_changes(timeout=max(next_sweep - time.monotonic(), 0))
+        if changes is None:
+            continue
+        if changes and not apply_replicated_changes(elastic_conn, state, changes):
+            # Сервер отдаст неподтвержденные изменения после переподключения.
+            source.close()
+            continue
+        state.set_state('replication_lsn', format_lsn(changes.lsn))
+        state.flush()
+        source.confirm(changes.lsn)
 
 
 @backoff.on_exception(
     backoff.expo,
     ConnectionError,
     max_tries=50,
+    on_backoff=metrics.on_backoff,
 )
 def create_indexes(elastic_conn):
     """Создает индексы если их нет."""
-    elastic_database = LoadElastic(**elastic_conn)
+    elastic_database = resources.load_elastic(elastic_conn)
 
     for index in ("movies", "genres", "persons"):
         if elastic_database.es.indices.exists(index=index):
             logging.info(f'Index {index} already exist.')
+            # Новые поля схемы добавляются в существующий индекс.
+            elastic_database.es.indices.put_mapping(
+                index=index, properties=index_to_schema[index]['mappings']['properties'])
         else:
             data_create_index = {
                 "index": index,
@@ -118,19 +472,227 @@ def create_indexes(elastic_conn):
             )
 
 
+def full_passes() -> tuple:
+    """Проходы полной загрузки: индекс, функция прохода и пропускаемые таблицы."""
+    return (
+        ('movies', process_etl_movies, (('genre', 'modified'), ('person', 'modified'))),
+        ('genres', process_etl_genres, ()),
+        ('persons', process_etl_persons, (('person_film_work', 'created'),)),
+    )
+
+
+def full_pass_state(postgres_extract: PostgresExtract, skipped_tables) -> State:
+    """Чистое состояние для полного прохода.
+
+    Полный проход по film_work уже подхватывает текущие жанры и персоны,
+    а полный проход по персонам - их связи, поэтому эти таблицы
+    начинаются с последних изменений.
+    """
+    pass_state = State(MemoryStorage())
+    for table, column in skipped_tables:
+        if cursor := postgres_extract.get_last_cursor(table, column):
+            save_cursor(pass_state, table, cursor)
+    return pass_state
+
+
+@connect_to_database
+def process_full_reindex(elastic_conn, state, pg_conn=None):
+    """Полная переиндексация в новые версии индексов с переключением алиасов.
+
+    Загрузка идет с чистого состояния, а найденные при ней курсоры
+    переносятся в основное состояние, чтобы инкрементальный режим
+    продолжил с места окончания переиндексации.
+    """
+    postgres_extract = PostgresExtract(pg_conn=pg_conn)
+    es = resources.load_elastic(elastic_conn).es
+    # Проход по фильмам пропускает старые изменения жанров и персон,
+    # поэтому их имена перечитываются из базы.
+    if dimensions is not None:
+        dimensions.clear()
+
+    for alias, process_etl_func, skipped_tables in full_passes():
+        # Ошибки внутренних проходов не должны глушиться, иначе алиас
+        # переключится на недостроенный индекс.
+        process_etl_func = process_etl_func.__wrapped__
+        reindex_state = full_pass_state(postgres_extract, skipped_tables)
+        index = full_reindex(
+            es, alias,
+            lambda index: process_etl_func(elastic_conn, reindex_state, pg_conn, index=index),
+            replicas=etl_settings.reindex_replicas,
+        )
+        if fingerprints is not None:
+            fingerprints.move(index, alias)
+        for key, value in reindex_state.state.items():
+            state.set_state(key, value)
+        state.flush()
+
+
+def spool_snapshot(directory: str) -> bool:
+    """Записать полную выгрузку фильмов, жанров и персон в сегменты без Elasticsearch.
+
+    Проходы те же, что у полной переиндексации, но пачки после transform
+    уходят в SpoolWriter. Сегменты и курсоры, на которых закончилась
+    выгрузка, фиксируются только после всех проходов, а прерванная
+    выгрузка удаляет свои сегменты. Возвращает False, если соединение с
+    Postgres оборвалось.
+    """
+    spool = SpoolWriter(directory, segment_bytes=etl_settings.spool_segment_mb * 1024 * 1024)
+    snapshot_state = {}
+    try:
+        with resources.pg_connection() as pg_conn:
+            postgres_extract = PostgresExtract(pg_conn=pg_conn)
+            for alias, process_etl_func, skipped_tables in full_passes():
+                pass_state = full_pass_state(postgres_extract, skipped_tables)
+                process_etl_func.__wrapped__(None, pass_state, pg_conn, index=alias, spool=spool)
+                snapshot_state.update(pass_state.state)
+        spool.commit(snapshot_state)
+    except psycopg2.OperationalError:
+        logging.error('Connection refused, snapshot is incomplete')
+        return False
+    finally:
+        spool.close()
+    logging.info(f'Snapshot spooled to {directory}')
+    return True
+
+
+def replay_snapshot(elastic_conn, state, directory: str) -> bool:
+    """Загрузить сегменты --spool в новые версии индексов с переключением алиасов.
+
+    Postgres не нужен: документы уходят в bulk готовыми байтами из
+    ETL_REPLAY_READERS потоков, а курсоры выгрузки переносятся в
+    состояние, чтобы инкрементальный режим продолжил с них. Возвращает
+    False, если каталога нет или выгрузка в нем не завершена.
+    """
+    try:
+        replayer = SpoolReplayer(directory, readers=etl_settings.replay_readers, batch_size=etl_settings.itersize)
+        snapshot_state = replayer.state()
+    except SpoolError as ex:
+        logging.error(ex)
+        return False
+    elastic_database = resources.load_elastic(elastic_conn)
+    for alias in replayer.indexes():
+        index = full_reindex(
+            elastic_database.es, alias,
+            lambda index: replayer.replay(elastic_database, alias, index),
+            replicas=etl_settings.reindex_replicas,
+        )
+        if fingerprints is not None:
+            fingerprints.move(index, alias)
+    for key, value in snapshot_state.items():
+        state.set_state(key, value)
+    state.flush()
+    return True
+
+
+def build_state(namespace: Optional[str] = None) -> State:
+    """Создать состояние в хранилище, выбранном в настройках.
+
+    С namespace состояние отделено от других воркеров: json-файл свой,
+    а в общих хранилищах ключи получают префикс.
+    """
+    state_path = etl_settings.state_path
+    if namespace and etl_settings.state_backend == 'json':
+        root, ext = os.path.splitext(state_path)
+        state_path = f'{root}.{namespace}{ext}'
+    storages: dict[str, Callable[[], BaseStorage]] = {
+        'json': lambda: AtomicJsonFileStorage(state_path),
+        'sqlite': lambda: SQLiteStorage(state_path),
+        'postgres': lambda: PostgresStorage(dsl),
+    }
+    storage = storages[etl_settings.state_backend]()
+    if namespace and storage.partial_updates:
+        storage = NamespacedStorage(storage, namespace)
+    return State(
+        storage,
+        flush_interval=etl_settings.state_flush_interval,
+        flush_every=etl_settings.state_flush_every,
+    )
+
+
+def run_worker(shard: Shard) -> None:
+    """Цикл опроса одного воркера по своему шарду фильмов."""
+    if etl_settings.metrics_port:
+        metrics.start_http_server(etl_settings.metrics_port + 1 + shard.index)
+    state = build_state(namespace=f'shard{shard.index}of{shard.count}')
+    elastic_conn = ElasticSettings().dict()
+    config = dotenv_values('../enviroments/.env')
+    while True:
+        run_polling_sweep(elastic_conn, state, shard=shard)
+        time.sleep(int(config.get('SLEEP')))
+
+
 def main():
-    state = State(JsonFileStorage('state.json'))
+    parser = argparse.ArgumentParser(description='ETL Postgres -> Elasticsearch.')
+    parser.add_argument('--full-reindex', action='store_true',
+                        help='перестроить индексы с нуля и переключить алиасы')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--listen', action='store_true',
+                      help='загружать изменения по LISTEN/NOTIFY вместо опроса')
+    mode.add_argument('--replication', action='store_true',
+                      help='загружать изменения из слота логической репликации')
+    mode.add_argument('--async', dest='use_async', action='store_true',
+                      help='опрос на asyncio: asyncpg, AsyncElasticsearch и все индексы одновременно')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число процессов, между которыми делятся фильмы')
+    parser.add_argument('--spool', metavar='DIR',
+                        help='выгрузить фильмы, жанры и персоны в сегменты ndjson.gz в пустой каталог и выйти')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='загрузить сегменты из --spool в Elasticsearch и выйти')
+    args = parser.parse_args()
+    if args.workers > 1 and (args.listen or args.replication or args.use_async):
+        # Supervisor не возвращает управление, режим был бы молча проигнорирован.
+        parser.error('--workers работает только в режиме опроса, без --listen, --replication и --async')
+
+    if etl_settings.metrics_port:
+        metrics.start_http_server(etl_settings.metrics_port)
+    if args.spool:
+        sys.exit(0 if spool_snapshot(args.spool) else 1)
+
+    state = build_state()
     elastic_conn = ElasticSettings().dict()
     config = dotenv_values('../enviroments/.env')
+
+    if args.replay:
+        sys.exit(0 if replay_snapshot(elastic_conn, state, args.replay) else 1)
+
     create_indexes(elastic_conn)
 
-    with sqlite3.connect('db.sqlite') as sqlite_conn, psycopg2.connect(**dsl, cursor_factory=DictCursor) as pg_conn:
-        load_from_sqlite(sqlite_conn, pg_conn)
+    migrate_from_sqlite(
+        'db.sqlite', dsl,
+        saver=CopyPostgresSaver if etl_settings.sqlite_loader == 'copy' else PostgresSaver,
+        parallel=etl_settings.sqlite_parallel,
+    )
+
+    if etl_settings.film_work_doc:
+        with psycopg2.connect(**dsl) as pg_conn:
+            install_film_work_doc(pg_conn)
+
+    if args.listen:
+        with psycopg2.connect(**dsl) as pg_conn:
+            install_listen(pg_conn, etl_settings.listen_channel)
+
+    if args.replication:
+        with psycopg2.connect(**dsl) as pg_conn:
+            install_replication(pg_conn, etl_settings.replication_publication)
+
+    if args.full_reindex:
+        process_full_reindex(elastic_conn, state)
+
+    if args.workers > 1:
+        Supervisor(run_worker, args.workers).run()
+
+    if args.listen:
+        listen_changes(elastic_conn, state)
+
+    if args.replication:
+        replicate_changes(elastic_conn, state)
+
+    if args.use_async:
+        asyncio.run(AsyncRuntime(dsl, elastic_conn, state, etl_settings, fingerprints, dimensions)
+                    .run(int(config.get('SLEEP'))))
 
     while True:
-        process_etl_movies(elastic_conn, state)
-        process_etl_genres(elastic_conn, state)
-        process_etl_persons(elastic_conn, state)
+        run_polling_sweep(elastic_conn, state)
         time.sleep(int(config.get('SLEEP')))
 
 
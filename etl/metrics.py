@@ -0,0 +1,162 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Metric:
+    """Метрика с метками в формате Prometheus."""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def _labels(self, key: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in self._values.items():
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [f'{self.name}{self._labels(key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f'{self.name}_bucket{self._labels(key, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{self._labels(key)} {total}')
+        lines.append(f'{self.name}_count{self._labels(key)} {cumulative}')
+        return lines
+
+
+stage_seconds = Histogram(
+    'etl_stage_seconds', 'Время стадии конвейера на пачку.', ('stage', 'index'))
+batch_size = Histogram(
+    'etl_batch_size', 'Число документов в пачке.', ('index',), buckets=SIZE_BUCKETS)
+documents = Counter(
+    'etl_documents_total', 'Документы по результату загрузки.', ('index', 'result'))
+es_rejections = Counter(
+    'etl_es_rejections_total', 'Документы, отклоненные Elasticsearch.', ('index', 'status'))
+bulk_bytes = Counter(
+    'etl_bulk_bytes_total', 'Байты ndjson, отправленные в bulk-запросах, до сжатия.', ('index',))
+backoff_retries = Counter(
+    'etl_backoff_retries_total', 'Повторы через backoff после ошибок соединения.', ('target',))
+connection_setup_seconds = Histogram(
+    'etl_connection_setup_seconds', 'Время установки соединения с Postgres и Elasticsearch.', ('target',))
+adaptive_batch_size = Gauge(
+    'etl_adaptive_batch_size', 'Текущий размер пачки адаптивного регулятора.', ('name',))
+checkpoint_lag = Gauge(
+    'etl_checkpoint_lag_seconds', 'Отставание сохраненного курсора от текущего времени.', ('key',))
+dimension_lookups = Counter(
+    'etl_dimension_lookups_total', 'Поиски жанров и персон в кэше обогащения.', ('dimension', 'result'))
+replication_changes = Counter(
+    'etl_replication_changes_total', 'Изменения строк, прочитанные из слота репликации.', ('table', 'action'))
+changeset_received = Counter(
+    'etl_changeset_received_total', 'Id фильмов, полученные набором изменений от источников.', ('source',))
+changeset_deduplicated = Counter(
+    'etl_changeset_deduplicated_total', 'Повторные id фильмов, отброшенные набором изменений до индексации.')
+
+REGISTRY: list[Metric] = [
+    stage_seconds, batch_size, documents, es_rejections, bulk_bytes, backoff_retries,
+    connection_setup_seconds, adaptive_batch_size, checkpoint_lag, dimension_lookups,
+    replication_changes, changeset_received, changeset_deduplicated,
+]
+
+
+def on_backoff(details: dict) -> None:
+    """Обработчик on_backoff для декораторов backoff."""
+    backoff_retries.inc(target=details['target'].__qualname__)
+
+
+def render() -> bytes:
+    return ('\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n').encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: Optional[int], host: str = '0.0.0.0') -> None:
+    """Отдавать метрики на http://host:port/metrics в фоновом потоке."""
+    if not port:
+        return
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='etl-metrics', daemon=True).start()
+    logging.info(f'Metrics are available on :{port}/metrics')
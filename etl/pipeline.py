@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Any, AsyncIterable, Callable, Iterable
+
+import metrics
+
+_STOP = object()
+
+
+class OrderedCheckpointer:
+    """Продвигает состояние только по непрерывному префиксу загруженных пачек.
+
+    Пачки загружаются параллельно и завершаются в произвольном порядке,
+    поэтому контрольная точка пачки сохраняется лишь после того, как
+    загружены все пачки перед ней.
+    """
+
+    def __init__(self, checkpoint: Callable[[Any], None]):
+        self._checkpoint = checkpoint
+        self._lock = threading.Lock()
+        self._done: dict[int, Any] = {}
+        self._next_seq = 0
+
+    def done(self, seq: int, checkpoint: Any) -> None:
+        with self._lock:
+            self._done[seq] = checkpoint
+            while self._next_seq in self._done:
+                checkpoint = self._done.pop(self._next_seq)
+                if checkpoint is not None:
+                    self._checkpoint(checkpoint)
+                self._next_seq += 1
+
+
+class Pipeline:
+    """Конвейер extract -> transform -> load с ограниченными очередями между стадиями.
+
+    Источник читается в отдельном потоке, преобразование выполняет пул
+    потоков, загрузку - один или несколько писателей. Ограниченные очереди
+    дают обратное давление: если Elasticsearch не успевает, чтение из
+    Postgres приостанавливается.
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[Any], Any],
+        load: Callable[[Any], Any],
+        checkpoint: Callable[[Any], None],
+        transform_workers: int = 2,
+        load_workers: int = 1,
+        queue_size: int = 4,
+        name: str = '',
+    ):
+        self.transform = transform
+        self.load = load
+        self.checkpoint = checkpoint
+        self.transform_workers = max(transform_workers, 1)
+        self.load_workers = max(load_workers, 1)
+        self.queue_size = queue_size
+        self.name = name
+
+    def run(self, source: Iterable[tuple[Any, Any]]) -> None:
+        """Прогнать через конвейер пары (контрольная точка, пачка) из источника."""
+        self._error = None
+        self._stop = threading.Event()
+        transform_queue = queue.Queue(self.queue_size)
+        load_queue = queue.Queue(self.queue_size)
+        checkpointer = OrderedCheckpointer(self.checkpoint)
+
+        extract_thread = threading.Thread(
+            target=self._extract, args=(source, transform_queue), name='etl-extract')
+        transform_threads = [
+            threading.Thread(target=self._transform, args=(transform_queue, load_queue),
+                             name=f'etl-transform-{number}')
+            for number in range(self.transform_workers)
+        ]
+        load_threads = [
+            threading.Thread(target=self._load, args=(load_queue, checkpointer),
+                             name=f'etl-load-{number}')
+            for number in range(self.load_workers)
+        ]
+        for thread in (extract_thread, *transform_threads, *load_threads):
+            thread.start()
+
+        extract_thread.join()
+        for _ in transform_threads:
+            self._put(transform_queue, _STOP)
+        for thread in transform_threads:
+            thread.join()
+        for _ in load_threads:
+            self._put(load_queue, _STOP)
+        for thread in load_threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _extract(self, source, transform_queue) -> None:
+        try:
+            started = time.perf_counter()
+            for seq, (checkpoint, batch) in enumerate(source):
+                metrics.stage_seconds.observe(
+                    time.perf_counter() - started, stage='extract', index=self.name)
+                if not self._put(transform_queue, (seq, checkpoint, batch)):
+                    return
+                started = time.perf_counter()
+        except Exception as ex:
+            self._fail(ex)
+
+    def _transform(self, transform_queue, load_queue) -> None:
+        while (item := self._get(transform_queue)) is not _STOP:
+            seq, checkpoint, batch = item
+            try:
+                with metrics.stage_seconds.time(stage='transform', index=self.name):
+                    docs = self.transform(batch)
+            except Exception as ex:
+                self._fail(ex)
+                return
+            if not self._put(load_queue, (seq, checkpoint, docs)):
+                return
+
+    def _load(self, load_queue, checkpointer: OrderedCheckpointer) -> None:
+        while (item := self._get(load_queue)) is not _STOP:
+            seq, checkpoint, docs = item
+            try:
+                if docs:
+                    metrics.batch_size.observe(len(docs), index=self.name)
+                with metrics.stage_seconds.time(stage='index', index=self.name):
+                    self.load(docs)
+                checkpointer.done(seq, checkpoint)
+            except Exception as ex:
+                self._fail(ex)
+                return
+
+    def _fail(self, ex: Exception) -> None:
+        logging.error(f'Pipeline stage {threading.current_thread().name} failed: {ex}')
+        if self._error is None:
+            self._error = ex
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _STOP
+
+
+class AsyncPipeline(Pipeline):
+    """Конвейер extract -> transform -> load для asyncio.
+
+    Источник - асинхронный итератор, load - корутина. Преобразование
+    уходит в пул потоков, чтобы не блокировать цикл событий, а
+    load_workers задач загрузки держат столько же bulk-запросов в полете.
+    """
+
+    async def run(self, source: AsyncIterable[tuple[Any, Any]]) -> None:
+        transform_queue = asyncio.Queue(self.queue_size)
+        load_queue = asyncio.Queue(self.queue_size)
+        checkpointer = OrderedCheckpointer(self.checkpoint)
+        self._transforms_left = self.transform_workers
+
+        tasks = [
+            asyncio.create_task(self._extract(source, transform_queue)),
+            *(asyncio.create_task(self._transform(transform_queue, load_queue))
+              for _ in range(self.transform_workers)),
+            *(asyncio.create_task(self._load(load_queue, checkpointer))
+              for _ in range(self.load_workers)),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                logging.error(f'Pipeline stage {self.name} failed: {task.exception()}')
+                raise task.exception()
+
+    async def _extract(self, source, transform_queue) -> None:
+        seq = 0
+        started = time.perf_counter()
+        async for checkpoint, batch in source:
+            metrics.stage_seconds.observe(
+                time.perf_counter() - started, stage='extract', index=self.name)
+            await transform_queue.put((seq, checkpoint, batch))
+            seq += 1
+            started = time.perf_counter()
+        for _ in range(self.transform_workers):
+            await transform_queue.put(_STOP)
+
+    async def _transform(self, transform_queue, load_queue) -> None:
+        loop = asyncio.get_running_loop()
+        while (item := await transform_queue.get()) is not _STOP:
+            seq, checkpoint, batch = item
+            with metrics.stage_seconds.time(stage='transform', index=self.name):
+                docs = await loop.run_in_executor(None, self.transform, batch)
+            await load_queue.put((seq, checkpoint, docs))
+        self._transforms_left -= 1
+        if not self._transforms_left:
+            for _ in range(self.load_workers):
+                await load_queue.put(_STOP)
+
+    async def _load(self, load_queue, checkpointer: OrderedCheckpointer) -> None:
+        while (item := await load_queue.get()) is not _STOP:
+            seq, checkpoint, docs = item
+            if docs:
+                metrics.batch_size.observe(len(docs), index=self.name)
+            with metrics.stage_seconds.time(stage='index', index=self.name):
+                await self.load(docs)
+            checkpointer.done(seq, checkpoint)
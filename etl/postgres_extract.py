@@ -1,19 +1,44 @@
 import logging
+from typing import Iterator, Optional
+from uuid import uuid4
 
 import backoff
 from elastic_transport import ConnectionError
 from psycopg2.extensions import connection as _connection
 from psycopg2.extras import DictCursor
 
+import metrics
+from batching import AdaptiveBatchSize
+from sharding import Shard
+
 
 class PostgresExtract:
     """Класс реализует методы доступа к postgres."""
 
     LIMIT = 500
+    # Начальное значение курсора (modified, id) для пустого состояния.
+    MIN_MODIFIED = '-infinity'
+    MIN_ID = '00000000-0000-0000-0000-000000000000'
+    # Параметры курсора (modified, id) в тексте запроса.
+    KEYSET_PARAMS = '(%s, %s)'
 
-    def __init__(self, pg_conn: _connection):
+    def __init__(self, pg_conn: _connection, itersize: int = LIMIT, shard: Optional[Shard] = None,
+                 batch: Optional[AdaptiveBatchSize] = None):
         self.pg_conn = pg_conn
         self.curs = pg_conn.cursor()
+        self.itersize = itersize
+        self.shard = shard
+        self.batch = batch
+
+    @property
+    def page_size(self) -> int:
+        """Размер страницы id: от регулятора пачек, если он задан, иначе LIMIT."""
+        return self.batch.size if self.batch else self.LIMIT
+
+    @property
+    def fetch_size(self) -> int:
+        """Размер пачки строк: от регулятора пачек, если он задан, иначе itersize."""
+        return self.batch.size if self.batch else self.itersize
 
     def __del__(self):
         self.curs.close()
@@ -24,63 +49,114 @@ class PostgresExtract:
         backoff.expo,
         ConnectionError,
         max_tries=10,
+        on_backoff=metrics.on_backoff,
     )
-    def extract_data(query: str, curs: DictCursor) -> list:
-        curs.execute(query)
+    def extract_data(query: str, curs: DictCursor, params: Optional[tuple] = None) -> list:
+        curs.execute(query, params)
         data = curs.fetchall()
         return data
 
-    def get_ids_modified_data(self, table: str,  modified: str, offset: int):
-        """Получить обновленные данные."""
-        query: str = (
+    def stream_data(self, query: str, params: Optional[tuple] = None) -> Iterator[list]:
+        """Читать результат запроса серверным курсором пачками по fetch_size строк.
+
+        В памяти процесса одновременно находится не больше одной пачки,
+        сколько бы строк ни вернул запрос.
+        """
+        with self.pg_conn.cursor(name=f'etl_{uuid4().hex}', cursor_factory=DictCursor) as curs:
+            curs.itersize = self.itersize
+            curs.execute(query, params)
+            while rows := curs.fetchmany(self.fetch_size):
+                yield rows
+
+    def _shard_filter(self, column: str) -> str:
+        """Условие на фильмы своего шарда, если ETL запущен воркерами."""
+        return f"AND {self.shard.sql(column)} " if self.shard else ''
+
+    def get_ids_modified_data(self, table: str, modified: Optional[str], last_id: Optional[str]):
+        """Получить страницу обновленных данных после курсора (modified, id).
+
+        Keyset-пагинация: страница начинается строго после последней
+        прочитанной строки, поэтому строки с одинаковым modified не
+        теряются и не повторяются, а стоимость страницы не зависит от
+        её номера.
+        """
+        modified = modified or self.MIN_MODIFIED
+        last_id = last_id or self.MIN_ID
+        logging.info(f'{modified=}-{last_id=}-{table=}')
+        data = self.extract_data(self._ids_modified_query(table), self.curs, (modified, last_id))
+        if not data:
+            return None, []
+        last_row = data[-1]
+        return (last_row[1], last_row[0]), [row[0] for row in data]
+
+    def _ids_modified_query(self, table: str) -> str:
+        return (
             "SELECT id, modified "
             f"FROM content.{table} "
-            f"WHERE modified > '{modified}' "
-            "ORDER BY modified "
-            f"LIMIT {self.LIMIT} OFFSET {offset}"
+            f"WHERE (modified, id) > {self.KEYSET_PARAMS} "
+            f"{self._shard_filter('id') if table in ('film_work', 'film_work_doc') else ''}"
+            "ORDER BY modified, id "
+            f"LIMIT {self.page_size}"
+        )
+
+    def get_last_cursor(self, table: str, column: str = 'modified') -> Optional[tuple]:
+        """Получить курсор (modified, id) самой свежей строки таблицы."""
+        query: str = (
+            f"SELECT {column}, id "
+            f"FROM content.{table} "
+            f"WHERE {column} IS NOT NULL "
+            f"ORDER BY {column} DESC, id DESC "
+            "LIMIT 1"
         )
-        logging.info(f'{modified=}-{table=}')
         data = self.extract_data(query, self.curs)
-        if not data:
-            return '', []
-        last_modified = data[-1][1]
-        return last_modified, [data[0] for data in data]
+        return tuple(data[0]) if data else None
+
+    def iter_ids_modified_data(
+        self, table: str, modified: Optional[str], last_id: Optional[str]
+    ) -> Iterator[tuple[tuple, list]]:
+        """Постранично обойти обновленные данные таблицы.
+
+        Отдает пары ((modified, id) последней строки страницы, ids).
+        """
+        while True:
+            cursor, ids = self.get_ids_modified_data(table, modified, last_id)
+            if not ids:
+                return
+            yield cursor, ids
+            modified, last_id = cursor
 
     def get_ids_film_work_by_person(self, ids_person: list[str]):
         """Получить связанные фильмы из обновлений в персонах."""
-        ids = str(ids_person)[1:-1]
-        query: str = (
-            "SELECT fw.id "
-            "FROM content.film_work fw "
-            "LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id "
-            f"WHERE pfw.person_id IN ({ids}) "
-            "ORDER BY fw.modified "
-        )
+        query = self._film_work_by_link_query('person_film_work', 'person_id', ids_person)
         return tuple(data[0] for data in self.extract_data(query, self.curs))
 
     def get_ids_film_work_by_genre(self, ids_genre: list[str]):
         """Получить связанные фильмы из обновлений в жанрах."""
-        ids = str(ids_genre)[1:-1]
-        query: str = (
-            "SELECT fw.id "
-            "FROM content.film_work fw "
-            "LEFT JOIN content.genre_film_work pfw ON pfw.film_work_id = fw.id "
-            f"WHERE pfw.genre_id IN ({ids}) "
-            "ORDER BY fw.modified "
-        )
+        query = self._film_work_by_link_query('genre_film_work', 'genre_id', ids_genre)
         return tuple(data[0] for data in self.extract_data(query, self.curs))
 
+    def _film_work_by_link_query(self, link_table: str, column: str, ids_linked: list[str]) -> str:
+        ids = str(list(ids_linked))[1:-1]
+        return (
+            "SELECT DISTINCT l.film_work_id "
+            f"FROM content.{link_table} l "
+            f"WHERE l.{column} IN ({ids}) "
+            f"{self._shard_filter('l.film_work_id')}"
+        )
+
     def get_ids_data_modified(self, table, ids):
         return {
             'person': self.get_ids_film_work_by_person,
             'genre': self.get_ids_film_work_by_genre,
             'film_work': lambda _ids: ids,
+            'film_work_doc': lambda _ids: ids,
         }[table](ids)
 
-    def get_all_data_film_work(self, ids_film_work: list[str]):
-        """Получить всю информацию о фильме."""
+    @staticmethod
+    def _film_work_query(ids_film_work: list[str]) -> str:
+        """Запрос агрегированных данных фильмов без сортировки."""
         ids = str(ids_film_work)[1:-1]
-        query = (f"""
+        return (f"""
         SELECT fw.id AS id,
             fw.rating AS imdb_rating,
             fw.title,
@@ -100,28 +176,178 @@ class PostgresExtract:
             LEFT JOIN content.genre g ON g.id = gfw.genre_id
             WHERE fw.id IN ({ids})
             GROUP BY fw.id
+        """)
+
+    def get_all_data_film_work(self, ids_film_work: list[str]) -> Iterator[list]:
+        """Получить всю информацию о фильмах пачками по itersize."""
+        query = f"{self._film_work_query(ids_film_work)} ORDER BY fw.modified;"
+        return self.stream_data(query)
+
+    def get_film_work_links(self, ids_film_work: list[str]) -> Iterator[list]:
+        """Получить колонки фильмов и id их жанров и персон пачками по itersize.
+
+        Справочники не join-ятся: имена подставляются из кэша FilmDimensions.
+        """
+        return self.stream_data(self._film_work_links_query(ids_film_work))
+
+    @staticmethod
+    def _film_work_links_query(ids_film_work: list[str]) -> str:
+        ids = str(list(ids_film_work))[1:-1]
+        return (f"""
+        SELECT fw.id AS id,
+            fw.rating AS imdb_rating,
+            fw.title,
+            fw.description,
+            fw.created,
+            fw.modified,
+            ARRAY(SELECT gfw.genre_id::text FROM content.genre_film_work gfw
+                  WHERE gfw.film_work_id = fw.id) AS genre_ids,
+            ARRAY(SELECT ARRAY[pfw.person_id::text, pfw.role] FROM content.person_film_work pfw
+                  WHERE pfw.film_work_id = fw.id) AS person_roles
+            FROM content.film_work fw
+            WHERE fw.id IN ({ids})
+            ORDER BY fw.modified;
+        """)
+
+    def get_genre_names(self, ids_genre: list[str]) -> dict[str, str]:
+        """Названия жанров по списку id."""
+        return dict(self.extract_data(self._names_query('genre', 'name', ids_genre), self.curs))
+
+    def get_person_names(self, ids_person: list[str]) -> dict[str, str]:
+        """Имена персон по списку id."""
+        return dict(self.extract_data(self._names_query('person', 'full_name', ids_person), self.curs))
+
+    @staticmethod
+    def _names_query(table: str, column: str, ids_linked: list[str]) -> str:
+        ids = str(list(ids_linked))[1:-1]
+        return f"SELECT id::text, {column} FROM content.{table} WHERE id IN ({ids});"
+
+    def get_film_work_documents(self, ids_film_work: list[str]) -> Iterator[list]:
+        """Получить готовые json-документы фильмов пачками по itersize.
+
+        Документ собирается в Postgres в формате FilmworkSchemaOut и
+        отдается текстом, который без разбора уходит в тело bulk-запроса.
+        """
+        return self.stream_data(self._film_work_documents_query(ids_film_work))
+
+    @classmethod
+    def _film_work_documents_query(cls, ids_film_work: list[str]) -> str:
+        return (f"""
+        SELECT fw.id,
+            json_build_object(
+                'id', fw.id,
+                'imdb_rating', fw.imdb_rating,
+                'genre', array_remove(fw.genre, NULL),
+                'title', fw.title,
+                'description', fw.description,
+                'director', COALESCE(fw.director, '{{}}'::text[]),
+                'actors_names', fw.actors_names,
+                'writers_names', fw.writers_names,
+                'actors', fw.actors,
+                'writers', fw.writers
+            )::text AS doc
+            FROM ({cls._film_work_query(ids_film_work)}) fw
             ORDER BY fw.modified;
         """)
-        return self.extract_data(query, self.curs)
 
-    def get_modified_genres(self, modified: str):
-        query = (
+    def get_film_work_documents_from_table(self, ids_film_work: list[str]) -> Iterator[list]:
+        """Получить json-документы фильмов из content.film_work_doc пачками по itersize."""
+        return self.stream_data(self._film_work_documents_from_table_query(ids_film_work))
+
+    @staticmethod
+    def _film_work_documents_from_table_query(ids_film_work: list[str]) -> str:
+        ids = str(ids_film_work)[1:-1]
+        return f"SELECT d.id, d.doc::text AS doc FROM content.film_work_doc d WHERE d.id IN ({ids});"
+
+    def iter_modified_genres(self, modified: Optional[str], last_id: Optional[str]) -> Iterator[tuple[tuple, list]]:
+        """Пачками отдать жанры, обновленные после курсора (modified, id)."""
+        query = self._genres_query(
+            f"(g.modified, g.id) > {self.KEYSET_PARAMS}", order_by="g.modified, g.id")
+        return self._iter_modified(query, modified, last_id)
+
+    def iter_modified_persons(self, modified: Optional[str], last_id: Optional[str]) -> Iterator[tuple[tuple, list]]:
+        """Пачками отдать персоны, обновленные после курсора (modified, id)."""
+        query = self._persons_query(
+            f"(p.modified, p.id) > {self.KEYSET_PARAMS}", order_by="p.modified, p.id")
+        return self._iter_modified(query, modified, last_id)
+
+    def iter_person_ids_by_new_links(
+        self, created: Optional[str], last_id: Optional[str]
+    ) -> Iterator[tuple[tuple, list]]:
+        """Постранично отдать персон из связей с фильмами, созданных после курсора (created, id)."""
+        query = self._person_links_query()
+        while data := self.extract_data(
+                query, self.curs, (created or self.MIN_MODIFIED, last_id or self.MIN_ID)):
+            last_row = data[-1]
+            created, last_id = last_row['created'], last_row['id']
+            yield (created, last_id), list(dict.fromkeys(row['person_id'] for row in data))
+
+    def _person_links_query(self) -> str:
+        return (
+            "SELECT id, created, person_id "
+            "FROM content.person_film_work "
+            f"WHERE (created, id) > {self.KEYSET_PARAMS} "
+            "ORDER BY created, id "
+            f"LIMIT {self.page_size}"
+        )
+
+    @staticmethod
+    def _genres_query(where: str, order_by: Optional[str] = None) -> str:
+        return (
             "SELECT g.modified, g.id, g.name, g.description FROM content.genre g "
-            f"WHERE modified > '{modified}' ORDER BY g.modified;"
+            f"WHERE {where}"
+            f"{f' ORDER BY {order_by}' if order_by else ''};"
         )
-        data = self.extract_data(query, self.curs)
-        if not data:
-            return '', []
-        last_modified = data[-1][0]
-        return last_modified, self.extract_data(query, self.curs)
-
-    def get_modified_persons(self, modified: str):
-        query = (
-            "SELECT p.modified, p.id, p.full_name FROM content.person p "
-            f"WHERE modified > '{modified}' ORDER BY p.modified;"
+
+    @staticmethod
+    def _persons_query(where: str, order_by: Optional[str] = None) -> str:
+        """Запрос персон вместе с id их фильмов и ролями."""
+        return (
+            "SELECT p.modified, p.id, p.full_name, "
+            "COALESCE(array_agg(DISTINCT pfw.film_work_id::text) "
+            "FILTER (WHERE pfw.id IS NOT NULL), '{}') AS film_ids, "
+            "COALESCE(array_agg(DISTINCT pfw.role) "
+            "FILTER (WHERE pfw.id IS NOT NULL), '{}') AS roles "
+            "FROM content.person p "
+            "LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id "
+            f"WHERE {where} "
+            "GROUP BY p.id"
+            f"{f' ORDER BY {order_by}' if order_by else ''};"
         )
-        data = self.extract_data(query, self.curs)
-        if not data:
-            return '', []
-        last_modified = data[-1][0]
-        return last_modified, self.extract_data(query, self.curs)
+
+    def get_genres_by_ids(self, ids_genre: list[str]) -> Iterator[list]:
+        """Пачками отдать жанры по списку id."""
+        ids = str(list(ids_genre))[1:-1]
+        return self.stream_data(self._genres_query(f"g.id IN ({ids})"))
+
+    def get_persons_by_ids(self, ids_person: list[str]) -> Iterator[list]:
+        """Пачками отдать персоны по списку id."""
+        ids = str(list(ids_person))[1:-1]
+        query = self._persons_query(f"p.id IN ({ids})")
+        return self.stream_data(query)
+
+    def get_deleted_rows(self) -> list:
+        """Получить первую страницу журнала удалений."""
+        return self.extract_data(self._deleted_rows_query(), self.curs)
+
+    def remove_deleted_rows(self, ids: list[int]) -> None:
+        """Убрать обработанные строки из журнала удалений и зафиксировать это."""
+        self.curs.execute(self._remove_deleted_rows_query(ids))
+        self.pg_conn.commit()
+
+    def _deleted_rows_query(self) -> str:
+        return (
+            "SELECT id, table_name, row_id, film_work_id, person_id "
+            "FROM content.deleted_rows "
+            f"ORDER BY id LIMIT {self.page_size}"
+        )
+
+    @staticmethod
+    def _remove_deleted_rows_query(ids: list[int]) -> str:
+        return f"DELETE FROM content.deleted_rows WHERE id IN ({str(list(ids))[1:-1]});"
+
+    def _iter_modified(self, query: str, modified: Optional[str], last_id: Optional[str]):
+        params = (modified or self.MIN_MODIFIED, last_id or self.MIN_ID)
+        for rows in self.stream_data(query, params):
+            last_row = rows[-1]
+            yield (last_row['modified'], last_row['id']), rows
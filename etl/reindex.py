@@ -0,0 +1,91 @@
+import logging
+import re
+from copy import deepcopy
+from typing import Callable, Optional
+
+from elasticsearch import Elasticsearch
+
+from indexes import index_to_schema, settings_index
+
+# Настройки индекса на время массовой загрузки.
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+def next_index_version(es: Elasticsearch, alias: str) -> str:
+    """Получить имя следующей версии индекса вида movies_v2."""
+    pattern = re.compile(rf'^{alias}_v(\d+)$')
+    versions = [
+        int(match.group(1))
+        for name in es.indices.get(index=f'{alias}_v*', allow_no_indices=True)
+        if (match := pattern.match(name))
+    ]
+    return f'{alias}_v{max(versions, default=0) + 1}'
+
+
+def create_bulk_load_index(es: Elasticsearch, alias: str, index: str) -> None:
+    """Создать версионный индекс без обновлений и реплик на время загрузки."""
+    body = deepcopy(index_to_schema[alias])
+    body['settings'].update(BULK_LOAD_SETTINGS)
+    es.indices.create(index=index, body=body)
+    logging.info(f'Index {index} created for full reindex of {alias}.')
+
+
+def live_replicas(es: Elasticsearch, alias: str) -> Optional[int]:
+    """Число реплик индекса, который сейчас отвечает на запросы по алиасу."""
+    if not es.indices.exists(index=alias):
+        return None
+    settings = es.indices.get_settings(index=alias, name='index.number_of_replicas')
+    return max(int(item['settings']['index']['number_of_replicas']) for item in settings.values())
+
+
+def finalize_index(es: Elasticsearch, index: str, replicas: int) -> None:
+    """Вернуть настройки индекса после загрузки и слить сегменты."""
+    es.indices.put_settings(index=index, settings={
+        'refresh_interval': settings_index['settings']['refresh_interval'],
+        'number_of_replicas': replicas,
+    })
+    es.indices.refresh(index=index)
+    es.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+
+
+def swap_alias(es: Elasticsearch, alias: str, index: str) -> list[str]:
+    """Атомарно переключить алиас на новый индекс.
+
+    Возвращает индексы, на которые алиас указывал раньше. Если вместо
+    алиаса существует обычный индекс с тем же именем, он удаляется в той же
+    операции.
+    """
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    old_indexes = []
+    if es.indices.exists_alias(name=alias):
+        old_indexes = [name for name in es.indices.get_alias(name=alias) if name != index]
+        actions += [{'remove': {'index': name, 'alias': alias}} for name in old_indexes]
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    es.indices.update_aliases(actions=actions)
+    logging.info(f'Alias {alias} now points to {index}.')
+    return old_indexes
+
+
+def full_reindex(es: Elasticsearch, alias: str, load: Callable[[str], None], replicas: int = 1) -> str:
+    """Полностью перестроить индекс за алиасом без простоя для поиска.
+
+    Данные загружаются функцией load в новый версионный индекс, после чего
+    алиас переключается на него, а старые версии удаляются. Новый индекс
+    получает столько же реплик, сколько было у текущего, replicas - только
+    для первой загрузки. Если загрузка упала, недостроенный индекс удаляется.
+    """
+    index = next_index_version(es, alias)
+    original_replicas = live_replicas(es, alias)
+    create_bulk_load_index(es, alias, index)
+    try:
+        load(index)
+        finalize_index(es, index, replicas if original_replicas is None else original_replicas)
+    except Exception:
+        logging.error(f'Full reindex of {alias} failed, deleting {index}.')
+        es.indices.delete(index=index, ignore_unavailable=True)
+        raise
+    for old_index in swap_alias(es, alias, index):
+        es.indices.delete(index=old_index)
+        logging.info(f'Old index {old_index} deleted.')
+    return index
@@ -0,0 +1,304 @@
+import logging
+import select
+import struct
+import time
+from typing import NamedTuple, Optional
+
+import backoff
+import orjson
+import psycopg2
+from psycopg2 import sql
+from psycopg2.errors import DuplicateObject
+from psycopg2.extensions import connection as _connection
+from psycopg2.extras import LogicalReplicationConnection, REPLICATION_LOGICAL
+
+import metrics
+from listener import ChangeBatch
+
+REPLICATION_DDL = 'schema_design/replication.ddl'
+
+# Таблицы схемы content, изменения которых попадают в индексы.
+TABLES = ('film_work', 'genre', 'person', 'genre_film_work', 'person_film_work')
+
+
+def install_replication(pg_conn: _connection, publication: str = 'etl_content') -> None:
+    """Включить REPLICA IDENTITY FULL для таблиц связей и создать публикацию.
+
+    Нужны права владельца таблиц и CREATE на базе; ошибки не глушатся,
+    чтобы режим --replication не запускался без публикации.
+    """
+    with pg_conn.cursor() as curs:
+        with open(REPLICATION_DDL, 'r') as ddl:
+            curs.execute(sql.SQL(ddl.read()).format(
+                publication=sql.Identifier(publication), publication_name=sql.Literal(publication)))
+        pg_conn.commit()
+
+
+class RowChange(NamedTuple):
+    """Изменение одной строки: action - insert, update или delete.
+
+    В new - строка после изменения, в old - ключ или вся строка до него
+    (для delete и update при REPLICA IDENTITY FULL). Значения текстовые.
+    """
+
+    table: str
+    action: str
+    new: dict
+    old: dict
+
+
+class Wal2JsonDecoder:
+    """Разбор сообщений wal2json с format-version 2: одно изменение на сообщение."""
+
+    ACTIONS = {'I': 'insert', 'U': 'update', 'D': 'delete'}
+    decode = True
+
+    def options(self, publication: str) -> dict:
+        return {
+            'format-version': '2',
+            'include-transaction': 'false',
+            'add-tables': ','.join(f'content.{table}' for table in TABLES),
+        }
+
+    def decode_message(self, payload: str) -> list[RowChange]:
+        message = orjson.loads(payload)
+        action = self.ACTIONS.get(message.get('action'))
+        if action is None or message.get('schema') != 'content':
+            return []
+        return [RowChange(
+            table=message['table'],
+            action=action,
+            new=self._row(message.get('columns')),
+            old=self._row(message.get('identity')),
+        )]
+
+    @staticmethod
+    def _row(columns: Optional[list]) -> dict:
+        return {column['name']: column['value'] for column in columns or ()}
+
+
+class PgOutputDecoder:
+    """Разбор двоичного протокола pgoutput (proto_version 1).
+
+    Сообщения Relation описывают колонки таблиц и приходят перед первым
+    изменением таблицы, поэтому декодер помнит их по oid.
+    """
+
+    decode = False
+
+    def __init__(self):
+        self.relations: dict[int, tuple[str, str, list[str]]] = {}
+
+    def options(self, publication: str) -> dict:
+        return {'proto_version': '1', 'publication_names': publication}
+
+    def decode_message(self, payload: bytes) -> list[RowChange]:
+        kind, body = payload[:1], memoryview(payload)[1:]
+        if kind == b'R':
+            self._relation(body)
+        elif kind in (b'I', b'U', b'D'):
+            return self._change(kind, body)
+        elif kind == b'T':
+            logging.warning('TRUNCATE is not replicated, run --full-reindex')
+        return []
+
+    def _relation(self, body: memoryview) -> None:
+        (relid,) = struct.unpack_from('!I', body)
+        offset = 4
+        namespace, offset = self._string(body, offset)
+        name, offset = self._string(body, offset)
+        # Пропускаем replica identity, число колонок читаем следом.
+        (count,) = struct.unpack_from('!H', body, offset + 1)
+        offset += 3
+        columns = []
+        for _ in range(count):
+            column, offset = self._string(body, offset + 1)
+            columns.append(column)
+            offset += 8
+        self.relations[relid] = (namespace, name, columns)
+
+    def _change(self, kind: bytes, body: memoryview) -> list[RowChange]:
+        (relid,) = struct.unpack_from('!I', body)
+        namespace, table, columns = self.relations[relid]
+        offset, new, old = 4, {}, {}
+        while offset < len(body):
+            marker = bytes(body[offset:offset + 1])
+            values, offset = self._tuple(body, offset + 1)
+            row = {column: value for column, value in zip(columns, values) if value is not None}
+            if marker == b'N':
+                new = row
+            else:
+                old = row
+        if namespace != 'content':
+            return []
+        action = {b'I': 'insert', b'U': 'update', b'D': 'delete'}[kind]
+        return [RowChange(table=table, action=action, new=new, old=old)]
+
+    @staticmethod
+    def _tuple(body: memoryview, offset: int) -> tuple[list, int]:
+        (count,) = struct.unpack_from('!H', body, offset)
+        offset += 2
+        values = []
+        for _ in range(count):
+            kind = bytes(body[offset:offset + 1])
+            offset += 1
+            if kind == b't':
+                (length,) = struct.unpack_from('!I', body, offset)
+                values.append(bytes(body[offset + 4:offset + 4 + length]).decode())
+                offset += 4 + length
+            else:
+                # 'n' - NULL, 'u' - неизмененное TOAST-значение.
+                values.append(None)
+        return values, offset
+
+    @staticmethod
+    def _string(body: memoryview, offset: int) -> tuple[str, int]:
+        end = bytes(body[offset:]).index(b'\0') + offset
+        return bytes(body[offset:end]).decode(), end + 1
+
+
+DECODERS = {'wal2json': Wal2JsonDecoder, 'pgoutput': PgOutputDecoder}
+
+
+def format_lsn(lsn: int) -> str:
+    return f'{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}'
+
+
+class ReplicationBatch(ChangeBatch):
+    """Пачка изменений из слота репликации.
+
+    Вставки и обновления собираются как уведомления LISTEN/NOTIFY, а
+    удаления - строками в формате журнала content.deleted_rows для
+    Tombstones. lsn - позиция последнего прочитанного сообщения.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.deleted_rows: list[dict] = []
+        self.lsn: Optional[int] = None
+
+    def add_change(self, change: RowChange) -> None:
+        if change.table not in TABLES:
+            return
+        metrics.replication_changes.inc(table=change.table, action=change.action)
+        if change.action != 'delete':
+            for row in (change.old, change.new):
+                if row.get('id'):
+                    self.add({'table': change.table, **row})
+            return
+        row = change.old
+        if change.table.endswith('_film_work') and not row.get('film_work_id'):
+            logging.warning(f'Delete from content.{change.table} without film_work_id, '
+                            'set REPLICA IDENTITY FULL on the table')
+            return
+        self.deleted_rows.append({
+            'id': None,
+            'table_name': change.table,
+            'row_id': row['id'],
+            'film_work_id': row.get('film_work_id'),
+            'person_id': row.get('person_id'),
+        })
+        self.count += 1
+
+
+class ReplicationSource:
+    """Читает изменения схемы content из слота логической репликации.
+
+    Слот создается при первом подключении. Сервер хранит WAL с позиции,
+    подтвержденной confirm, поэтому после перезапуска или обрыва чтение
+    продолжается с последней загруженной пачки. Пачки собираются так же,
+    как у ChangeListener: после первого сообщения ждем debounce секунд
+    тишины, но не дольше max_wait и не больше max_batch изменений.
+    """
+
+    def __init__(self, dsl: dict, slot: str = 'etl_content', plugin: str = 'pgoutput',
+                 publication: str = 'etl_content', debounce: float = 0.2, max_wait: float = 1.0,
+                 max_batch: int = 500):
+        self.dsl = dsl
+        self.slot = slot
+        self.plugin = plugin
+        self.publication = publication
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.conn = None
+        self.curs = None
+        self.decoder = None
+        self.confirmed_lsn: Optional[str] = None
+
+    @backoff.on_exception(
+        backoff.expo,
+        psycopg2.OperationalError,
+        max_tries=50,
+        on_backoff=metrics.on_backoff,
+    )
+    def connect(self, start_lsn: Optional[str] = None) -> None:
+        """Подключиться к слоту и читать его с start_lsn или с подтвержденной позиции."""
+        self.close()
+        self.confirmed_lsn = start_lsn or self.confirmed_lsn
+        self.conn = psycopg2.connect(**self.dsl, connection_factory=LogicalReplicationConnection)
+        self.curs = self.conn.cursor()
+        try:
+            self.curs.create_replication_slot(
+                self.slot, slot_type=REPLICATION_LOGICAL, output_plugin=self.plugin)
+            logging.info(f'Replication slot {self.slot} created')
+        except DuplicateObject:
+            pass
+        self.decoder = DECODERS[self.plugin]()
+        self.curs.start_replication(
+            slot_name=self.slot, decode=self.decoder.decode, start_lsn=self.confirmed_lsn or 0,
+            options=self.decoder.options(self.publication))
+        logging.info(f'Streaming replication slot {self.slot} from {self.confirmed_lsn or "slot position"}')
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = self.curs = None
+
+    def wait_changes(self, timeout: float) -> Optional[ReplicationBatch]:
+        """Дождаться пачки сообщений не дольше timeout секунд.
+
+        Пачка возвращается и без интересных ETL изменений, чтобы ее lsn
+        можно было подтвердить и сервер не копил WAL.
+        """
+        if self.conn is None or self.conn.closed:
+            self.connect()
+        batch = ReplicationBatch()
+        try:
+            if not self._poll(batch, timeout):
+                return None
+            started = time.monotonic()
+            while len(batch) < self.max_batch:
+                left = self.max_wait - (time.monotonic() - started)
+                if left <= 0 or not self._poll(batch, min(self.debounce, left)):
+                    break
+        except psycopg2.OperationalError:
+            logging.error('Replication connection lost')
+            self.close()
+            # Непрочитанная до конца пачка будет прочитана заново.
+            return None
+        return batch if batch.lsn is not None else None
+
+    def confirm(self, lsn: int) -> None:
+        """Сообщить серверу, что изменения до lsn загружены."""
+        self.confirmed_lsn = format_lsn(lsn)
+        if self.curs is not None:
+            self.curs.send_feedback(flush_lsn=lsn, reply=True)
+
+    def _poll(self, batch: ReplicationBatch, timeout: float) -> bool:
+        """Дочитать доступные сообщения в пачку, вернуть True если они были."""
+        message = self.curs.read_message()
+        if message is None:
+            if select.select([self.curs], [], [], timeout) == ([], [], []):
+                return False
+            message = self.curs.read_message()
+        received = False
+        while message is not None:
+            for change in self.decoder.decode_message(message.payload):
+                batch.add_change(change)
+            batch.lsn = message.data_start
+            received = True
+            if len(batch) >= self.max_batch:
+                break
+            message = self.curs.read_message()
+        return received
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import psycopg2
+from elastic_transport import TransportError
+from psycopg2.extensions import connection as _connection
+from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
+from load_to_elastic import LoadElastic
+
+
+class TimedConnectionPool(ThreadedConnectionPool):
+    """Пул psycopg2, который пишет время установки соединения в метрики."""
+
+    def _connect(self, key=None):
+        with metrics.connection_setup_seconds.time(target='postgres'):
+            return super()._connect(key)
+
+
+class Resources:
+    """Долгоживущие соединения ETL, общие для всех циклов процесса.
+
+    Соединения Postgres берутся из пула, а не открываются на каждый
+    проход, клиент Elasticsearch создается один раз на настройки и
+    держит keep-alive соединения. Соединение, простоявшее дольше
+    health_check_interval, перед выдачей проверяется и при обрыве
+    заменяется новым.
+    """
+
+    def __init__(self, dsl: dict, pool_size: int = 5, health_check_interval: float = 30):
+        self.dsl = dsl
+        self.pool_size = pool_size
+        self.health_check_interval = health_check_interval
+        self._pool: Optional[ThreadedConnectionPool] = None
+        self._elastic: dict[tuple, LoadElastic] = {}
+        self._elastic_used: dict[tuple, float] = {}
+        self._last_used: dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ThreadedConnectionPool:
+        with self._lock:
+            if self._pool is None:
+                # Соединения открываются по требованию, поэтому пул можно
+                # создать и при недоступной базе.
+                self._pool = TimedConnectionPool(0, self.pool_size, **self.dsl, cursor_factory=DictCursor)
+            return self._pool
+
+    @contextmanager
+    def pg_connection(self) -> Iterator[_connection]:
+        """Взять соединение из пула на время блока, закрыв транзакцию на выходе."""
+        pg_conn = self._checkout()
+        broken = False
+        try:
+            with pg_conn:
+                yield pg_conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            close = broken or bool(pg_conn.closed)
+            if close:
+                self._last_used.pop(id(pg_conn), None)
+            else:
+                self._last_used[id(pg_conn)] = time.monotonic()
+            self.pool.putconn(pg_conn, close=close)
+
+    def _checkout(self) -> _connection:
+        pg_conn = self.pool.getconn()
+        if self._healthy(pg_conn):
+            return pg_conn
+        logging.warning('Pooled postgres connection is broken, reconnecting')
+        self._last_used.pop(id(pg_conn), None)
+        self.pool.putconn(pg_conn, close=True)
+        return self.pool.getconn()
+
+    def _healthy(self, pg_conn: _connection) -> bool:
+        if pg_conn.closed:
+            return False
+        last_used = self._last_used.get(id(pg_conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with pg_conn.cursor() as curs:
+                curs.execute('SELECT 1;')
+            pg_conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def load_elastic(self, elastic_conn: dict) -> LoadElastic:
+        """Общий LoadElastic для настроек; после простоя клиент проверяется ping."""
+        key = tuple(sorted(elastic_conn.items()))
+        with self._lock:
+            elastic = self._elastic.get(key)
+            idle = time.monotonic() - self._elastic_used.get(key, 0)
+            if elastic is not None and idle >= self.health_check_interval and not self._ping(elastic):
+                logging.warning('Elasticsearch does not answer ping, recreating the client')
+                elastic.es.close()
+                elastic = None
+            if elastic is None:
+                # Первый ping открывает соединение, его время и есть установка.
+                with metrics.connection_setup_seconds.time(target='elasticsearch'):
+                    elastic = self._elastic[key] = LoadElastic(**elastic_conn)
+                    self._ping(elastic)
+            self._elastic_used[key] = time.monotonic()
+            return elastic
+
+    @staticmethod
+    def _ping(elastic: LoadElastic) -> bool:
+        try:
+            return elastic.es.ping()
+        except TransportError:
+            return False
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            for elastic in self._elastic.values():
+                elastic.es.close()
+            self._elastic.clear()
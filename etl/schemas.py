@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseModel, BaseSettings, Field, validator
+from pydantic import BaseModel, BaseSettings, Field, root_validator, validator
 
 
 class PersonSchema(BaseModel):
@@ -34,9 +34,73 @@ class GenreSchemaOut(BaseModel):
 class PersonSchemaOut(BaseModel):
     id: str
     full_name: str
+    film_ids: list[str] = []
+    roles: list[str] = []
 
 
 class ElasticSettings(BaseSettings):
     es_host: str = Field('http://elasticsearch:9200', env='ES_HOST')
     es_user: str = Field('', env='ES_USER')
     es_password: str = Field('', env='ES_PASSWORD')
+    bulk_mode: Literal['streaming', 'parallel'] = Field('streaming', env='ES_BULK_MODE')
+    chunk_size: int = Field(500, env='ES_CHUNK_SIZE')
+    max_chunk_bytes: int = Field(100 * 1024 * 1024, env='ES_MAX_CHUNK_BYTES')
+    thread_count: int = Field(4, env='ES_THREAD_COUNT')
+    max_retries: int = Field(5, env='ES_MAX_RETRIES')
+    payload_log_rate: float = Field(0.0, env='ES_PAYLOAD_LOG_RATE')
+    connections_per_node: int = Field(10, env='ES_CONNECTIONS_PER_NODE')
+    http_compress: bool = Field(True, env='ES_HTTP_COMPRESS')
+
+
+class EtlSettings(BaseSettings):
+    itersize: int = Field(500, env='ETL_ITERSIZE')
+    state_backend: Literal['json', 'sqlite', 'postgres'] = Field('json', env='ETL_STATE_BACKEND')
+    state_path: Optional[str] = Field(None, env='ETL_STATE_PATH')
+    state_flush_interval: float = Field(0, env='ETL_STATE_FLUSH_INTERVAL')
+    state_flush_every: int = Field(1, env='ETL_STATE_FLUSH_EVERY')
+    transform_workers: int = Field(2, env='ETL_TRANSFORM_WORKERS')
+    load_workers: int = Field(1, env='ETL_LOAD_WORKERS')
+    queue_size: int = Field(4, env='ETL_QUEUE_SIZE')
+    transform_mode: Literal['pydantic', 'raw'] = Field('pydantic', env='ETL_TRANSFORM_MODE')
+    validate_every: int = Field(100, env='ETL_VALIDATE_EVERY')
+    film_work_doc: bool = Field(False, env='ETL_FILM_WORK_DOC')
+    enrichment: Literal['join', 'cache'] = Field('join', env='ETL_ENRICHMENT')
+    dimension_cache_size: int = Field(100000, env='ETL_DIMENSION_CACHE_SIZE')
+    changeset_max_ids: int = Field(50000, env='ETL_CHANGESET_MAX_IDS')
+    sqlite_loader: Literal['insert', 'copy'] = Field('insert', env='ETL_SQLITE_LOADER')
+    sqlite_parallel: bool = Field(True, env='ETL_SQLITE_PARALLEL')
+    fingerprint_path: Optional[str] = Field(None, env='ETL_FINGERPRINT_PATH')
+    reindex_replicas: int = Field(1, env='ETL_REINDEX_REPLICAS')
+    spool_segment_mb: int = Field(64, env='ETL_SPOOL_SEGMENT_MB')
+    replay_readers: int = Field(4, env='ETL_REPLAY_READERS')
+    listen_channel: str = Field('content_changes', env='ETL_LISTEN_CHANNEL')
+    listen_debounce: float = Field(0.2, env='ETL_LISTEN_DEBOUNCE')
+    listen_max_wait: float = Field(1.0, env='ETL_LISTEN_MAX_WAIT')
+    sweep_interval: int = Field(300, env='ETL_SWEEP_INTERVAL')
+    replication_slot: str = Field('etl_content', env='ETL_REPLICATION_SLOT')
+    replication_plugin: Literal['pgoutput', 'wal2json'] = Field('pgoutput', env='ETL_REPLICATION_PLUGIN')
+    replication_publication: str = Field('etl_content', env='ETL_REPLICATION_PUBLICATION')
+    metrics_port: Optional[int] = Field(None, env='ETL_METRICS_PORT')
+    pg_pool_size: int = Field(5, env='ETL_PG_POOL_SIZE')
+    health_check_interval: float = Field(30, env='ETL_HEALTH_CHECK_INTERVAL')
+    adaptive_batch: bool = Field(True, env='ETL_ADAPTIVE_BATCH')
+    batch_min_size: int = Field(50, env='ETL_BATCH_MIN_SIZE')
+    batch_max_size: int = Field(5000, env='ETL_BATCH_MAX_SIZE')
+    batch_target_mb: float = Field(5, env='ETL_BATCH_TARGET_MB')
+    batch_target_latency: float = Field(1.0, env='ETL_BATCH_TARGET_LATENCY')
+    bulks_in_flight: int = Field(4, env='ETL_BULKS_IN_FLIGHT')
+
+    @validator('state_path', always=True)
+    def default_state_path(cls, value, values):
+        # У json и sqlite разные форматы файла, поэтому и пути по умолчанию разные.
+        if value is None and values.get('state_backend') in ('json', 'sqlite'):
+            return {'json': 'state.json', 'sqlite': 'state.sqlite'}[values['state_backend']]
+        return value
+
+    @root_validator
+    def validate_film_work_doc(cls, values):
+        if values.get('film_work_doc') and values.get('transform_mode') != 'raw':
+            raise ValueError('ETL_FILM_WORK_DOC requires ETL_TRANSFORM_MODE=raw')
+        if values.get('enrichment') == 'cache' and values.get('transform_mode') != 'pydantic':
+            raise ValueError('ETL_ENRICHMENT=cache requires ETL_TRANSFORM_MODE=pydantic')
+        return values
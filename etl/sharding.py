@@ -0,0 +1,20 @@
+from typing import NamedTuple
+
+# Номер шарда берется из последних 7 hex-цифр uuid, чтобы Postgres
+# считал его без расширений.
+SHARD_HEX_DIGITS = 7
+
+
+class Shard(NamedTuple):
+    """Часть фильмов, которую обрабатывает один воркер."""
+
+    index: int
+    count: int
+
+    def sql(self, column: str) -> str:
+        """Условие WHERE, оставляющее строки этого шарда."""
+        return (
+            f"mod(('x' || lpad(right({column}::text, {SHARD_HEX_DIGITS}), 8, '0'))::bit(32)::int, "
+            f"{self.count}) = {self.index}"
+        )
+
@@ -0,0 +1,197 @@
+import gzip
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional, Union
+
+import orjson
+from pydantic import BaseModel
+
+import metrics
+from load_to_elastic import BulkReport, LoadElastic, RawDocument
+
+SEGMENT_SUFFIX = '.ndjson.gz'
+STATE_FILE = 'state.json'
+
+
+class SpoolError(Exception):
+    """Каталог выгрузки отсутствует или выгрузка в нем не завершена."""
+
+
+class _Segment:
+    """Открытый на запись сегмент одного индекса."""
+
+    def __init__(self, path: str, compresslevel: int):
+        self.path = path
+        self.tmp_path = f'{path}.tmp'
+        self.file = gzip.open(self.tmp_path, 'wb', compresslevel=compresslevel)
+        self.size = 0
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+
+    def promote(self) -> None:
+        self.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self) -> None:
+        self.close()
+        os.remove(self.tmp_path)
+
+
+class SpoolWriter:
+    """Пишет преобразованные пачки в сжатые сегменты ndjson вместо Elasticsearch.
+
+    Документы индекса пишутся в каталог directory/<index>/ сегментами не
+    больше segment_bytes несжатых байт. Документ хранится парой строк
+    bulk без имени индекса, поэтому при воспроизведении его можно
+    загрузить в любой индекс. Сегменты пишутся во временные файлы и
+    получают свои имена только в commit вместе с state.json, поэтому
+    прерванная выгрузка не оставляет сегментов, которые можно загрузить.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, compresslevel: int = 6):
+        # Сегменты прошлой выгрузки смешались бы с новыми, а при
+        # параллельном воспроизведении старая копия документа может
+        # загрузиться после свежей.
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError(f'Spool directory {directory} is not empty')
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compresslevel = compresslevel
+        self._segments: dict[str, _Segment] = {}
+        self._written: list[_Segment] = []
+        self._numbers: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def write(self, index: str, docs: list[Union[BaseModel, RawDocument]]) -> int:
+        """Дописать пачку документов в сегмент индекса, вернуть число несжатых байт."""
+        lines = b''.join(map(self._lines, docs))
+        with self._lock:
+            segment = self._segment(index)
+            segment.file.write(lines)
+            segment.size += len(lines)
+            if segment.size >= self.segment_bytes:
+                segment.close()
+                del self._segments[index]
+                self._written.append(segment)
+        metrics.documents.inc(len(docs), index=index, result='spooled')
+        return len(lines)
+
+    def commit(self, state: dict) -> None:
+        """Завершить выгрузку: переименовать сегменты и сохранить курсоры, на
+        которых она закончилась. state.json пишется последним."""
+        with self._lock:
+            for segment in [*self._written, *self._segments.values()]:
+                segment.promote()
+            self._written, self._segments = [], {}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(orjson.dumps(state))
+        os.replace(f'{path}.tmp', path)
+
+    def close(self) -> None:
+        """Удалить сегменты, не вошедшие в commit."""
+        with self._lock:
+            for segment in [*self._written, *self._segments.values()]:
+                segment.discard()
+            self._written, self._segments = [], {}
+
+    @staticmethod
+    def _lines(doc: Union[BaseModel, RawDocument]) -> bytes:
+        source = doc.source if isinstance(doc, RawDocument) else orjson.dumps(doc.dict())
+        return orjson.dumps({'index': {'_id': doc.id}}) + b'\n' + source + b'\n'
+
+    def _segment(self, index: str) -> _Segment:
+        if index not in self._segments:
+            directory = os.path.join(self.directory, index)
+            os.makedirs(directory, exist_ok=True)
+            self._numbers[index] = self._numbers.get(index, 0) + 1
+            path = os.path.join(directory, f'{self._numbers[index]:08d}{SEGMENT_SUFFIX}')
+            self._segments[index] = _Segment(path, self.compresslevel)
+        return self._segments[index]
+
+
+def list_segments(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(SEGMENT_SUFFIX))
+
+
+def read_segment(path: str, batch_size: int) -> Iterator[list[RawDocument]]:
+    """Читать сегмент пачками документов без разбора их _source."""
+    with gzip.open(path, 'rb') as f:
+        docs = []
+        for action in f:
+            (meta,) = orjson.loads(action).values()
+            docs.append(RawDocument(meta['_id'], next(f).rstrip(b'\n')))
+            if len(docs) >= batch_size:
+                yield docs
+                docs = []
+        if docs:
+            yield docs
+
+
+class SpoolReplayer:
+    """Загружает записанные SpoolWriter сегменты в Elasticsearch.
+
+    Сегменты индекса читаются readers потоками одновременно, каждый
+    поток отправляет свои пачки готовыми байтами без моделей и без
+    обращений к Postgres.
+    """
+
+    def __init__(self, directory: str, readers: int = 4, batch_size: int = 500):
+        if not os.path.isdir(directory):
+            raise SpoolError(f'Spool directory {directory} does not exist')
+        self.directory = directory
+        self.readers = max(readers, 1)
+        self.batch_size = batch_size
+
+    def indexes(self) -> list[str]:
+        """Индексы, для которых в каталоге есть сегменты."""
+        return sorted(name for name in os.listdir(self.directory)
+                      if list_segments(os.path.join(self.directory, name)))
+
+    def state(self) -> dict:
+        """Курсоры выгрузки; без state.json выгрузка считается прерванной."""
+        try:
+            with open(os.path.join(self.directory, STATE_FILE), 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            raise SpoolError(f'{self.directory} has no {STATE_FILE}, the snapshot is incomplete') from None
+
+    def replay(self, elastic: LoadElastic, index: str, target: Optional[str] = None) -> BulkReport:
+        """Загрузить сегменты индекса index в индекс target (по умолчанию тот же)."""
+        target = target or index
+        segments = list_segments(os.path.join(self.directory, index))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='etl-replay') as executor:
+            reports = list(executor.map(lambda path: self._replay_segment(elastic, path, target), segments))
+        report = BulkReport()
+        for segment_report in reports:
+            self._merge(report, segment_report)
+        elapsed = time.perf_counter() - started
+        logging.info(
+            f'Replayed {len(segments)} segments of {index} into {target}: '
+            f'{report.success} docs, {report.failed} failed, {elapsed:.1f}s, '
+            f'{report.success / elapsed if elapsed else 0:.0f} docs/sec')
+        return report
+
+    def _replay_segment(self, elastic: LoadElastic, path: str, target: str) -> BulkReport:
+        total = BulkReport()
+        for docs in read_segment(path, self.batch_size):
+            self._merge(total, elastic.send_raw_to_es(docs, target))
+        return total
+
+    @staticmethod
+    def _merge(total: BulkReport, report: BulkReport) -> None:
+        total.success += report.success
+        total.retried += report.retried
+        total.errors += report.errors
+        total.bytes += report.bytes
+        total.sent_bytes += report.sent_bytes
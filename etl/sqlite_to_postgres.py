@@ -1,10 +1,15 @@
+import io
 import logging
 import sqlite3
-import sys
-from contextlib import contextmanager
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from typing import Iterator, Optional, Type
 
 import orjson
+import psycopg2
 
+from batching import AdaptiveBatchSize
 from models.models import table_to_schema
 from psycopg2.extensions import connection as _connection
 
@@ -12,6 +17,10 @@ logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
 
 
+class MigrationError(Exception):
+    """Batch could not be written; committed batches and their progress are kept."""
+
+
 @contextmanager
 def cursor_manager(conn):
     curs = conn.cursor()
@@ -56,8 +65,32 @@ class PostgresSaver(CreateSqlQuery):
             except Exception as ex:
                 logging.info(f'Execption {ex}')
 
-    def save_all_data(self, current_table, dict_values):
-        """Save data."""
+    def get_progress(self, table: str) -> int:
+        """Last SQLite rowid of the table already committed to Postgres."""
+        with cursor_manager(self.pg_conn) as cursor:
+            cursor.execute(
+                f"SELECT last_rowid FROM {self.schema_name}.sqlite_migration WHERE table_name = %s;",
+                (table,))
+            row = cursor.fetchone()
+        self.pg_conn.commit()
+        return row[0] if row else 0
+
+    def save_progress(self, cursor, table: str, last_rowid: Optional[int]) -> None:
+        """Move the table high-water mark in the transaction of its batch."""
+        if last_rowid is None:
+            return
+        cursor.execute(
+            f"INSERT INTO {self.schema_name}.sqlite_migration (table_name, last_rowid) VALUES (%s, %s) "
+            "ON CONFLICT (table_name) DO UPDATE SET last_rowid = excluded.last_rowid, updated = now();",
+            (table, last_rowid))
+
+    def save_batch(self, table: str, rows: list[sqlite3.Row], last_rowid: Optional[int] = None) -> int:
+        """Save raw SQLite rows of one batch."""
+        model_schema = table_to_schema[table]
+        return self.save_all_data(table, [model_schema(**row) for row in rows], last_rowid)
+
+    def save_all_data(self, current_table, dict_values, last_rowid: Optional[int] = None) -> int:
+        """Save data and return the size of the inserted values."""
         current_model = table_to_schema[current_table]
         fields = current_model.get_fields()
         template = self.create_template(fields)
@@ -68,15 +101,81 @@ class PostgresSaver(CreateSqlQuery):
                 args = ','.join(cursor.mogrify(template, self.get_values(
                     item)).decode() for item in dict_values)
                 cursor.execute(f"INSERT INTO {self.schema_name}.{current_table} {values} "
-                               f"VALUES {args} ON CONFLICT (id) DO NOTHING RETURNING id;")
-                last_id_row = cursor.fetchall()
-                if last_id_row:
-                    self.pg_conn.commit()
+                               f"VALUES {args} ON CONFLICT (id) DO NOTHING;")
+                self.save_progress(cursor, current_table, last_rowid)
+                self.pg_conn.commit()
             except Exception as ex:
-                sys.exit(f"Exception while inserting data to postgres. {ex}")
+                self.pg_conn.rollback()
+                raise MigrationError(f"Exception while inserting data to postgres. {ex}") from ex
+        return len(args)
+
+
+class CopyPostgresSaver(PostgresSaver):
+    """Save batches of rows with COPY into a temporary table.
+
+    SQLite rows are written in the COPY text format as they are, without
+    building pydantic models, and moved from the temporary table with a
+    single INSERT ... ON CONFLICT DO NOTHING.
+    """
+
+    # Escapes for the special characters of the COPY text format.
+    COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+    @classmethod
+    def copy_value(cls, value) -> str:
+        """Value in the COPY text format: NULL as \\N, special characters escaped."""
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value).translate(cls.COPY_ESCAPES)
+
+    @classmethod
+    def copy_rows(cls, rows, fields: list[str]) -> str:
+        return ''.join('\t'.join(cls.copy_value(row[field]) for field in fields) + '\n' for row in rows)
+
+    def save_batch(self, table: str, rows: list[sqlite3.Row], last_rowid: Optional[int] = None) -> int:
+        return self.save_rows(table, rows, last_rowid)
+
+    def save_rows(self, current_table: str, rows: list[sqlite3.Row], last_rowid: Optional[int] = None) -> int:
+        """Save rows with COPY and return the size of the data sent."""
+        fields = table_to_schema[current_table].get_fields()
+        columns = ', '.join(fields)
+        staging_table = f'staging_{current_table}'
+
+        # The COPY text format tells NULL (\N) from an empty string, while CSV
+        # without an explicit NULL option would load NULL as an empty string.
+        buffer = io.StringIO(self.copy_rows(rows, fields))
+
+        with cursor_manager(self.pg_conn) as cursor:
+            try:
+                cursor.execute(
+                    f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} "
+                    f"(LIKE {self.schema_name}.{current_table} INCLUDING DEFAULTS) "
+                    "ON COMMIT DELETE ROWS;")
+                cursor.copy_expert(
+                    f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT text)", buffer)
+                cursor.execute(
+                    f"INSERT INTO {self.schema_name}.{current_table} ({columns}) "
+                    f"SELECT {columns} FROM {staging_table} ON CONFLICT DO NOTHING;")
+                self.save_progress(cursor, current_table, last_rowid)
+                self.pg_conn.commit()
+            except Exception as ex:
+                self.pg_conn.rollback()
+                raise MigrationError(f"Exception while copying data to postgres. {ex}") from ex
+        return len(buffer.getvalue())
 
 
 class SQLiteExtractor:
+    TABLES: list[str] = ["genre", "person", "film_work",
+                         "genre_film_work", "person_film_work"]
+    # Tables without foreign keys to each other, they can be loaded in parallel.
+    INDEPENDENT_TABLES: list[str] = ["genre", "person", "film_work"]
+    LINK_TABLES: list[str] = ["genre_film_work", "person_film_work"]
+    COUNT_ROWS = 1000
+    # Column with the SQLite rowid in the selected rows.
+    ROWID = '_rowid'
+
     def __init__(self, sqlite_conn: sqlite3.Connection):
         self.sqlite_conn = sqlite_conn
         self.schema_name = None
@@ -90,38 +189,80 @@ class SQLiteExtractor:
         conn.row_factory = sqlite3.Row
         yield conn
 
-    def extract_data(self, postgres_saver):
-        """Get all data from sqlite."""
-        with self.conn_context() as conn:
-            count_rows: int = 1000
-            tables: list[str] = ["genre", "person", "film_work",
-                                 "genre_film_work", "person_film_work"]
+    def extract_rows(self, table: str, count_rows: int = COUNT_ROWS,
+                     batch: Optional[AdaptiveBatchSize] = None,
+                     after_rowid: int = 0) -> Iterator[list[sqlite3.Row]]:
+        """Get raw rows of the table after after_rowid in batches, in rowid order.
 
+        Every row carries its rowid in the ROWID column. With batch the size
+        of every next batch is taken from the controller.
+        """
+        with self.conn_context() as conn:
             with cursor_manager(conn) as curs:
-                for table in tables:
-                    try:
-                        curs.execute(
-                            f'SELECT * FROM {table};')
-                    except Exception as ex:
-                        logging.info(f'Exception {ex}')
-                    while True:
-                        three_rows = curs.fetchmany(count_rows)
-                        if three_rows:
-                            model_schema = table_to_schema.get(table)
-                            yield table, (model_schema(**item) for item in three_rows)
-                        else:
-                            break
-
-
-def load_from_sqlite(connection: sqlite3.Connection, pg_conn: _connection):
-    """Main method to download data from SQLite to Postgres."""
-    postgres_saver = PostgresSaver(pg_conn)
-    sqlite_extractor = SQLiteExtractor(connection)
-    data_generator = sqlite_extractor.extract_data(postgres_saver)
-
-    # создаем схему из ddl файла.
-    postgres_saver.create_schema()
-
-    for table, values in data_generator:
-        logging.info(f'Запись данных в {table}')
-        postgres_saver.save_all_data(table, values)
+                try:
+                    curs.execute(
+                        f'SELECT rowid AS {self.ROWID}, * FROM {table} WHERE rowid > ? ORDER BY rowid;',
+                        (after_rowid,))
+                except Exception as ex:
+                    logging.info(f'Exception {ex}')
+                    return
+                while True:
+                    rows = curs.fetchmany(batch.size if batch else count_rows)
+                    if rows:
+                        yield rows
+                    else:
+                        break
+
+
+def sqlite_batch(table: str) -> AdaptiveBatchSize:
+    """Batch size controller for writes of one table into Postgres."""
+    return AdaptiveBatchSize(
+        f'sqlite_{table}', initial=SQLiteExtractor.COUNT_ROWS, maximum=20000,
+        target_bytes=8 * 1024 * 1024, target_latency=0.5,
+    )
+
+
+def migrate_table(sqlite_path: str, dsl: dict, table: str,
+                  saver: Type[PostgresSaver] = PostgresSaver) -> None:
+    """Move one table from SQLite to Postgres in its own connections.
+
+    Rows go in rowid order and every batch commits together with the table
+    high-water mark, so a restart continues after the last committed batch.
+    """
+    with closing(sqlite3.connect(sqlite_path)) as sqlite_conn, closing(psycopg2.connect(**dsl)) as pg_conn:
+        postgres_saver = saver(pg_conn)
+        after_rowid = postgres_saver.get_progress(table)
+        batch, rows_count = sqlite_batch(table), 0
+        extractor = SQLiteExtractor(sqlite_conn)
+        for rows in extractor.extract_rows(table, batch=batch, after_rowid=after_rowid):
+            started = time.perf_counter()
+            size = postgres_saver.save_batch(table, rows, rows[-1][SQLiteExtractor.ROWID])
+            batch.observe(len(rows), time.perf_counter() - started, size)
+            rows_count += len(rows)
+    if rows_count:
+        logging.info(f'Таблица {table} загружена, строк: {rows_count}')
+    else:
+        logging.info(f'Таблица {table} уже загружена')
+
+
+def migrate_from_sqlite(sqlite_path: str, dsl: dict, saver: Type[PostgresSaver] = PostgresSaver,
+                        parallel: bool = True) -> None:
+    """Load data from SQLite to Postgres, resuming from the committed progress.
+
+    Independent tables go first, link tables after them, so foreign keys
+    always find their rows. With parallel each group is loaded by
+    a thread per table.
+    """
+    with closing(psycopg2.connect(**dsl)) as pg_conn:
+        PostgresSaver(pg_conn).create_schema()
+        pg_conn.commit()
+
+    for tables in (SQLiteExtractor.INDEPENDENT_TABLES, SQLiteExtractor.LINK_TABLES):
+        if parallel:
+            with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+                for future in [executor.submit(migrate_table, sqlite_path, dsl, table, saver)
+                               for table in tables]:
+                    future.result()
+        else:
+            for table in tables:
+                migrate_table(sqlite_path, dsl, table, saver)
@@ -1,9 +1,24 @@
 import abc
 import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
 from typing import Any, Optional
 
+import psycopg2
+from psycopg2.extensions import connection as _connection
+
+import metrics
+
 
 class BaseStorage:
+    # Хранилище умеет обновлять отдельные ключи и получает только
+    # изменившуюся часть состояния, а не его полную копию.
+    partial_updates = False
+
     @abc.abstractmethod
     def save_state(self, state: dict) -> None:
         """Сохранить состояние в постоянное хранилище"""
@@ -38,16 +53,193 @@ class JsonFileStorage(BaseStorage):
             return {}
 
 
+class AtomicJsonFileStorage(JsonFileStorage):
+    """Json-файл, который перезаписывается атомарно.
+
+    Состояние пишется во временный файл рядом с основным, сбрасывается на
+    диск и подменяет основной файл через rename, поэтому падение во время
+    записи оставляет прежнюю целую версию.
+    """
+
+    def save_state(self, state: dict) -> None:
+        if self.file_path is None:
+            raise Exception('File not found')
+
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class MemoryStorage(BaseStorage):
+    """Хранилище состояния в памяти процесса."""
+
+    def __init__(self, state: Optional[dict] = None):
+        self.state = dict(state or {})
+
+    def save_state(self, state: dict) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+
+class SQLiteStorage(BaseStorage):
+    """Состояние в таблице SQLite, общей для нескольких процессов ETL."""
+
+    partial_updates = True
+
+    def __init__(self, file_path: str, table: str = 'etl_state'):
+        self.table = table
+        self.conn = sqlite3.connect(file_path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        with self.conn:
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT);')
+
+    def save_state(self, state: dict) -> None:
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT INTO {self.table} (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value;',
+                [(key, json.dumps(value)) for key, value in state.items()],
+            )
+
+    def retrieve_state(self) -> dict:
+        rows = self.conn.execute(f'SELECT key, value FROM {self.table};')
+        return {key: json.loads(value) for key, value in rows}
+
+
+class PostgresStorage(BaseStorage):
+    """Состояние в таблице Postgres, общей для нескольких воркеров ETL."""
+
+    partial_updates = True
+
+    def __init__(self, dsl: dict, table: str = 'public.etl_state'):
+        self.dsl = dsl
+        self.table = table
+        self.conn: Optional[_connection] = None
+        with self._cursor() as curs:
+            curs.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value JSONB NOT NULL);')
+
+    def _cursor(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.dsl)
+            self.conn.autocommit = True
+        return self.conn.cursor()
+
+    def save_state(self, state: dict) -> None:
+        with self._cursor() as curs:
+            curs.executemany(
+                f'INSERT INTO {self.table} (key, value) VALUES (%s, %s) '
+                'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;',
+                [(key, json.dumps(value)) for key, value in state.items()],
+            )
+
+    def retrieve_state(self) -> dict:
+        with self._cursor() as curs:
+            curs.execute(f'SELECT key, value FROM {self.table};')
+            return dict(curs.fetchall())
+
+
+class NamespacedStorage(BaseStorage):
+    """Пространство имен в общем хранилище: ключи получают префикс.
+
+    Нужно воркерам, которые делят одно key-value хранилище курсоров.
+    """
+
+    partial_updates = True
+
+    def __init__(self, storage: BaseStorage, namespace: str):
+        if not storage.partial_updates:
+            raise ValueError('Namespaced state requires a key-value storage')
+        self.storage = storage
+        self.prefix = f'{namespace}:'
+
+    def save_state(self, state: dict) -> None:
+        self.storage.save_state({self.prefix + key: value for key, value in state.items()})
+
+    def retrieve_state(self) -> dict:
+        return {
+            key[len(self.prefix):]: value
+            for key, value in self.storage.retrieve_state().items()
+            if key.startswith(self.prefix)
+        }
+
+
 class State:
-    """Класс для хранения состояния при работе с данными."""
+    """Класс для хранения состояния при работе с данными.
+
+    Запись в хранилище можно объединять: состояние сбрасывается не чаще
+    раза в flush_interval секунд или после flush_every изменений. При
+    падении теряются только несохраненные курсоры, и данные после них
+    будут загружены повторно.
+    """
 
-    def __init__(self, storage: BaseStorage):
+    def __init__(self, storage: BaseStorage, flush_interval: float = 0, flush_every: int = 1):
         self.storage = storage
         self.state = storage.retrieve_state()
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._dirty: set[str] = set()
+        self._updates = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
 
     def set_state(self, key: str, value: any) -> None:
-        self.state[key] = value
-        self.storage.save_state(self.state)
+        self.update_state({key: value})
+
+    def update_state(self, values: dict) -> None:
+        """Изменить несколько ключей сразу: они сохраняются одной записью."""
+        with self._lock:
+            self.state.update(values)
+            self._dirty.update(values)
+            self._updates += 1
+            # flush_interval <= 0 отключает сброс по времени.
+            if (self._updates >= self.flush_every
+                    or 0 < self.flush_interval <= time.monotonic() - self._last_flush):
+                self.flush()
 
     def get_state(self, key: str) -> Any:
         return self.state.get(key)
+
+    def flush(self) -> None:
+        """Сохранить накопленные изменения в хранилище."""
+        with self._lock:
+            if not self._dirty:
+                return
+            if self.storage.partial_updates:
+                self.storage.save_state({key: self.state[key] for key in self._dirty})
+            else:
+                self.storage.save_state(self.state)
+            self._dirty.clear()
+            self._updates = 0
+            self._last_flush = time.monotonic()
+
+
+def load_cursor(state: State, key: str) -> tuple:
+    """Прочитать из состояния курсор (modified, id)."""
+    return state.get_state(f'{key}_modified'), state.get_state(f'{key}_id')
+
+
+def save_cursor(state: State, key: str, cursor: tuple) -> None:
+    """Сохранить в состоянии курсор (modified, id)."""
+    last_modified, last_id = cursor
+    # Оба поля курсора меняются вместе, иначе после падения между двумя
+    # записями сохранится (новый modified, старый id) и строки пропустятся.
+    state.update_state({f'{key}_modified': last_modified.isoformat(), f'{key}_id': last_id})
+    metrics.checkpoint_lag.set(
+        (datetime.now(last_modified.tzinfo) - last_modified).total_seconds(), key=key)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули ETL импортируются как верхнеуровневые, как при запуске из etl/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,22 @@
+import metrics
+from changeset import ChangeSet
+
+
+def counter_value(counter: metrics.Counter, **labels) -> float:
+    return counter._values.get(counter._key(labels), 0)
+
+
+def test_changeset_exports_dedup_savings():
+    received = counter_value(metrics.changeset_received, source='genre')
+    deduplicated = counter_value(metrics.changeset_deduplicated)
+
+    change_set = ChangeSet()
+    change_set.add('film_work', ['a', 'b'], cursor=('2021-01-01', 'b'))
+    change_set.add('genre', ['a', 'b', 'c'])
+    ids, cursors = change_set.flush()
+
+    assert ids == ['a', 'b', 'c']
+    assert cursors == {'film_work': ('2021-01-01', 'b')}
+    assert counter_value(metrics.changeset_received, source='genre') - received == 3
+    assert counter_value(metrics.changeset_deduplicated) - deduplicated == 2
+    assert change_set.indexed == 3
@@ -0,0 +1,37 @@
+import orjson
+
+from load_to_elastic import LoadElastic, RawDocument
+
+
+class FakeBulkClient:
+    """Отвечает на bulk статусами из сценария: по очереди на каждую отправку id."""
+
+    def __init__(self, statuses: dict[str, list[int]]):
+        self.statuses = statuses
+        self.requests: list[list[str]] = []
+
+    def bulk(self, operations: bytes) -> dict:
+        lines = operations.splitlines()
+        ids = [orjson.loads(line)['index']['_id'] for line in lines[::2]]
+        self.requests.append(ids)
+        return {'items': [
+            {'index': {'_id': _id, 'status': self.statuses[_id].pop(0) if len(self.statuses[_id]) > 1
+                       else self.statuses[_id][0]}}
+            for _id in ids
+        ]}
+
+
+def test_only_429_items_are_retried_up_to_max_retries():
+    elastic = LoadElastic('http://localhost:9200', 'user', 'password', max_retries=2, initial_backoff=0)
+    elastic.es = FakeBulkClient({'a': [201], 'b': [429, 201], 'c': [400], 'd': [429]})
+    docs = [RawDocument(_id, b'{}') for _id in 'abcd']
+    actions = elastic._raw_actions(docs, 'movies')
+
+    report = elastic.send_raw_to_es(docs, 'movies')
+
+    assert elastic.es.requests == [['a', 'b', 'c', 'd'], ['b', 'd'], ['d']]
+    assert report.success == 2
+    assert report.retried == 3
+    assert sorted((error['_id'], error['status']) for error in report.errors) == [('c', 400), ('d', 429)]
+    assert report.bytes == sum(map(len, actions.values()))
+    assert report.sent_bytes == report.bytes + len(actions['b']) + 2 * len(actions['d'])
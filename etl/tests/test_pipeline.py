@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from pipeline import OrderedCheckpointer, Pipeline
+
+
+def test_checkpointer_waits_for_earlier_batches():
+    saved = []
+    checkpointer = OrderedCheckpointer(saved.append)
+    checkpointer.done(2, 'c2')
+    checkpointer.done(1, None)
+    assert saved == []
+    checkpointer.done(0, 'c0')
+    assert saved == ['c0', 'c2']
+
+
+def run_pipeline(batches: int, load, saved: list) -> None:
+    """Прогнать batches пачек, каждую в своем потоке загрузки."""
+    Pipeline(
+        transform=lambda batch: batch,
+        load=load,
+        checkpoint=saved.append,
+        load_workers=batches,
+        queue_size=batches,
+    ).run((f'cursor{number}', [number]) for number in range(batches))
+
+
+def test_pipeline_saves_cursors_in_order_when_loads_finish_out_of_order():
+    last_loaded = threading.Event()
+    finished = []
+
+    def load(docs):
+        # Первая пачка загружается последней.
+        if docs == [0]:
+            assert last_loaded.wait(5)
+        finished.append(docs[0])
+        if docs == [2]:
+            last_loaded.set()
+
+    saved = []
+    run_pipeline(3, load, saved)
+    assert finished[-1] == 0
+    assert saved == ['cursor0', 'cursor1', 'cursor2']
+
+
+def test_pipeline_does_not_checkpoint_past_failed_batch():
+    later_loaded = threading.Event()
+    saved = []
+
+    def load(docs):
+        if docs == [2]:
+            assert later_loaded.wait(5)
+            raise RuntimeError('bulk failed')
+        if docs == [3]:
+            later_loaded.set()
+
+    with pytest.raises(RuntimeError):
+        run_pipeline(4, load, saved)
+    assert saved == ['cursor0', 'cursor1']
@@ -0,0 +1,97 @@
+import pytest
+
+from reindex import full_reindex
+
+
+class FakeIndices:
+    """Индексы и алиасы в памяти с нужным full_reindex подмножеством API."""
+
+    def __init__(self):
+        self.settings: dict[str, dict] = {}
+        self.aliases: dict[str, str] = {}
+
+    def _resolve(self, name: str) -> list[str]:
+        if name in self.aliases:
+            return [self.aliases[name]]
+        if name.endswith('*'):
+            return [index for index in self.settings if index.startswith(name[:-1])]
+        return [name] if name in self.settings else []
+
+    def exists(self, index):
+        return bool(self._resolve(index))
+
+    def get(self, index, allow_no_indices=False):
+        return {name: {} for name in self._resolve(index)}
+
+    def get_settings(self, index, name=None):
+        return {
+            real: {'settings': {'index': {'number_of_replicas': str(self.settings[real]['number_of_replicas'])}}}
+            for real in self._resolve(index)
+        }
+
+    def create(self, index, body):
+        self.settings[index] = dict(body['settings'])
+
+    def put_settings(self, index, settings):
+        self.settings[index].update(settings)
+
+    def refresh(self, index):
+        pass
+
+    def forcemerge(self, index, max_num_segments):
+        pass
+
+    def delete(self, index, ignore_unavailable=False):
+        self.settings.pop(index, None)
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    def update_aliases(self, actions):
+        for action in actions:
+            if 'add' in action:
+                self.aliases[action['add']['alias']] = action['add']['index']
+
+
+class FakeElasticsearch:
+    def __init__(self):
+        self.indices = FakeIndices()
+
+    def options(self, **kwargs):
+        return self
+
+
+def test_full_reindex_restores_live_replicas():
+    es = FakeElasticsearch()
+    es.indices.settings['movies_v1'] = {'number_of_replicas': 2}
+    es.indices.aliases['movies'] = 'movies_v1'
+
+    index = full_reindex(es, 'movies', lambda index: None, replicas=1)
+
+    assert index == 'movies_v2'
+    assert es.indices.settings['movies_v2']['number_of_replicas'] == 2
+    assert es.indices.aliases['movies'] == 'movies_v2'
+    assert 'movies_v1' not in es.indices.settings
+
+
+def test_full_reindex_uses_setting_without_live_index():
+    es = FakeElasticsearch()
+    full_reindex(es, 'movies', lambda index: None, replicas=1)
+    assert es.indices.settings['movies_v1']['number_of_replicas'] == 1
+
+
+def test_full_reindex_deletes_half_built_index():
+    es = FakeElasticsearch()
+    es.indices.settings['movies_v1'] = {'number_of_replicas': 1}
+    es.indices.aliases['movies'] = 'movies_v1'
+
+    def load(index):
+        raise RuntimeError('bulk failed')
+
+    with pytest.raises(RuntimeError):
+        full_reindex(es, 'movies', load)
+    assert list(es.indices.settings) == ['movies_v1']
+    assert es.indices.aliases['movies'] == 'movies_v1'
@@ -0,0 +1,98 @@
+import struct
+
+import orjson
+
+from replication import PgOutputDecoder, RowChange, Wal2JsonDecoder
+
+RELID = 16385
+COLUMNS = ['id', 'film_work_id', 'person_id', 'role']
+
+
+def pg_string(value: str) -> bytes:
+    return value.encode() + b'\0'
+
+
+def pg_relation(relid: int, namespace: str, table: str, columns: list[str]) -> bytes:
+    body = struct.pack('!I', relid) + pg_string(namespace) + pg_string(table)
+    # replica identity 'f' (FULL), число колонок, затем флаги, имя, oid типа и typmod.
+    body += b'f' + struct.pack('!H', len(columns))
+    for column in columns:
+        body += b'\0' + pg_string(column) + struct.pack('!Ii', 25, -1)
+    return b'R' + body
+
+
+def pg_tuple(values: list) -> bytes:
+    data = struct.pack('!H', len(values))
+    for value in values:
+        if value is None:
+            data += b'n'
+        else:
+            data += b't' + struct.pack('!I', len(value.encode())) + value.encode()
+    return data
+
+
+def decoder_with_relation(namespace: str = 'content') -> PgOutputDecoder:
+    decoder = PgOutputDecoder()
+    assert decoder.decode_message(pg_relation(RELID, namespace, 'person_film_work', COLUMNS)) == []
+    return decoder
+
+
+def test_pgoutput_relation():
+    decoder = decoder_with_relation()
+    assert decoder.relations == {RELID: ('content', 'person_film_work', COLUMNS)}
+
+
+def test_pgoutput_insert():
+    decoder = decoder_with_relation()
+    message = b'I' + struct.pack('!I', RELID) + b'N' + pg_tuple(['1', 'fw', 'p', None])
+    assert decoder.decode_message(message) == [RowChange(
+        table='person_film_work', action='insert',
+        new={'id': '1', 'film_work_id': 'fw', 'person_id': 'p'}, old={})]
+
+
+def test_pgoutput_update_with_old_row():
+    decoder = decoder_with_relation()
+    message = (b'U' + struct.pack('!I', RELID)
+               + b'O' + pg_tuple(['1', 'fw', 'p', 'actor'])
+               + b'N' + pg_tuple(['1', 'fw2', 'p', 'actor']))
+    assert decoder.decode_message(message) == [RowChange(
+        table='person_film_work', action='update',
+        new={'id': '1', 'film_work_id': 'fw2', 'person_id': 'p', 'role': 'actor'},
+        old={'id': '1', 'film_work_id': 'fw', 'person_id': 'p', 'role': 'actor'})]
+
+
+def test_pgoutput_delete():
+    decoder = decoder_with_relation()
+    message = b'D' + struct.pack('!I', RELID) + b'O' + pg_tuple(['1', 'fw', 'p', 'writer'])
+    assert decoder.decode_message(message) == [RowChange(
+        table='person_film_work', action='delete', new={},
+        old={'id': '1', 'film_work_id': 'fw', 'person_id': 'p', 'role': 'writer'})]
+
+
+def test_pgoutput_skips_other_schemas():
+    decoder = decoder_with_relation(namespace='public')
+    message = b'I' + struct.pack('!I', RELID) + b'N' + pg_tuple(['1', 'fw', 'p', 'actor'])
+    assert decoder.decode_message(message) == []
+
+
+def wal2json(action: str, **fields) -> str:
+    return orjson.dumps({'action': action, 'schema': 'content', 'table': 'genre', **fields}).decode()
+
+
+def test_wal2json_insert_update_delete():
+    decoder = Wal2JsonDecoder()
+    columns = [{'name': 'id', 'type': 'uuid', 'value': 'g'}, {'name': 'name', 'type': 'text', 'value': 'Drama'}]
+    identity = [{'name': 'id', 'type': 'uuid', 'value': 'g'}]
+    assert decoder.decode_message(wal2json('I', columns=columns)) == [
+        RowChange('genre', 'insert', {'id': 'g', 'name': 'Drama'}, {})]
+    assert decoder.decode_message(wal2json('U', columns=columns, identity=identity)) == [
+        RowChange('genre', 'update', {'id': 'g', 'name': 'Drama'}, {'id': 'g'})]
+    assert decoder.decode_message(wal2json('D', identity=identity)) == [
+        RowChange('genre', 'delete', {}, {'id': 'g'})]
+
+
+def test_wal2json_skips_transactions_and_other_schemas():
+    decoder = Wal2JsonDecoder()
+    assert decoder.decode_message(orjson.dumps({'action': 'B'}).decode()) == []
+    assert decoder.decode_message(orjson.dumps(
+        {'action': 'I', 'schema': 'public', 'table': 'genre', 'columns': []}).decode()) == []
@@ -0,0 +1,11 @@
+from schemas import EtlSettings
+
+
+def test_state_path_default_depends_on_backend(monkeypatch):
+    monkeypatch.delenv('ETL_STATE_PATH', raising=False)
+    monkeypatch.setenv('ETL_STATE_BACKEND', 'json')
+    assert EtlSettings().state_path == 'state.json'
+    monkeypatch.setenv('ETL_STATE_BACKEND', 'sqlite')
+    assert EtlSettings().state_path == 'state.sqlite'
+    monkeypatch.setenv('ETL_STATE_PATH', 'custom.db')
+    assert EtlSettings().state_path == 'custom.db'
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from load_to_elastic import RawDocument
+from spool import SpoolError, SpoolReplayer, SpoolWriter, list_segments, read_segment
+
+
+def test_spool_round_trip(tmp_path):
+    writer = SpoolWriter(str(tmp_path / 'spool'), segment_bytes=1)
+    writer.write('genres', [RawDocument('1', b'{"name":"Drama"}')])
+    writer.write('genres', [RawDocument('2', b'{"name":"Comedy"}')])
+    writer.commit({'genres_table_id': '2'})
+    writer.close()
+
+    segments = list_segments(str(tmp_path / 'spool' / 'genres'))
+    assert [os.path.basename(path) for path in segments] == ['00000001.ndjson.gz', '00000002.ndjson.gz']
+    docs = [doc for path in segments for batch in read_segment(path, 10) for doc in batch]
+    assert docs == [RawDocument('1', b'{"name":"Drama"}'), RawDocument('2', b'{"name":"Comedy"}')]
+    replayer = SpoolReplayer(str(tmp_path / 'spool'))
+    assert replayer.indexes() == ['genres']
+    assert replayer.state() == {'genres_table_id': '2'}
+
+
+def test_interrupted_spool_leaves_no_segments(tmp_path):
+    writer = SpoolWriter(str(tmp_path), segment_bytes=1)
+    writer.write('genres', [RawDocument('1', b'{}')])
+    writer.write('genres', [RawDocument('2', b'{}')])
+    writer.close()
+
+    assert os.listdir(tmp_path / 'genres') == []
+    replayer = SpoolReplayer(str(tmp_path))
+    assert replayer.indexes() == []
+    with pytest.raises(SpoolError):
+        replayer.state()
+
+
+def test_replay_requires_existing_directory(tmp_path):
+    with pytest.raises(SpoolError):
+        SpoolReplayer(str(tmp_path / 'missing'))
+
+
+def test_spool_requires_empty_directory(tmp_path):
+    writer = SpoolWriter(str(tmp_path))
+    writer.write('genres', [RawDocument('1', b'{}')])
+    writer.commit({})
+    with pytest.raises(FileExistsError):
+        SpoolWriter(str(tmp_path))
@@ -0,0 +1,68 @@
+import io
+import os
+import re
+import sqlite3
+
+import pytest
+
+from sqlite_to_postgres import CopyPostgresSaver
+
+FIELDS = ['id', 'title', 'description', 'rating', 'file_path']
+COPY_UNESCAPES = {'\\\\': '\\', '\\t': '\t', '\\n': '\n', '\\r': '\r'}
+
+
+def parse_copy_text(data: str, fields: list[str]) -> list[dict]:
+    """Разбор текстового формата COPY по правилам Postgres."""
+    rows = []
+    for line in data.split('\n')[:-1]:
+        values = [
+            None if value == '\\N' else re.sub(r'\\[\\tnr]', lambda m: COPY_UNESCAPES[m.group()], value)
+            for value in line.split('\t')
+        ]
+        rows.append(dict(zip(fields, values)))
+    return rows
+
+
+def sqlite_rows(rows: list[tuple]) -> list[sqlite3.Row]:
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'CREATE TABLE film_work ({", ".join(FIELDS)})')
+    conn.executemany('INSERT INTO film_work VALUES (?, ?, ?, ?, ?)', rows)
+    return conn.execute('SELECT * FROM film_work ORDER BY rowid').fetchall()
+
+
+def test_copy_rows_round_trip_keeps_nulls_apart_from_empty_strings():
+    rows = sqlite_rows([
+        ('a', 'Title', None, None, None),
+        ('b', '', '', 1.5, 'path'),
+        ('c', 'tab\there', 'line\nbreak\\slash', 0.0, '\\N'),
+    ])
+
+    parsed = parse_copy_text(CopyPostgresSaver.copy_rows(rows, FIELDS), FIELDS)
+
+    expected = [{field: None if row[field] is None else str(row[field]) for field in FIELDS} for row in rows]
+    assert parsed == expected
+    assert parsed[0]['description'] is None
+    assert parsed[1]['description'] == ''
+
+
+def test_copy_value_encodes_null_and_bool():
+    assert CopyPostgresSaver.copy_value(None) == '\\N'
+    assert CopyPostgresSaver.copy_value(True) == 't'
+    assert CopyPostgresSaver.copy_value('') == ''
+
+
+@pytest.mark.skipif(not os.environ.get('ETL_TEST_DSN'), reason='ETL_TEST_DSN is not set')
+def test_copy_into_postgres_keeps_nulls():
+    psycopg2 = pytest.importorskip('psycopg2')
+    rows = sqlite_rows([('a', 'Title', None, None, None), ('b', 'Title', '', 1.5, 'path')])
+    with psycopg2.connect(os.environ['ETL_TEST_DSN']) as pg_conn, pg_conn.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMP TABLE film_work (id text, title text, description text, '
+            'rating double precision, file_path text);')
+        cursor.copy_expert(
+            f'COPY film_work ({", ".join(FIELDS)}) FROM STDIN WITH (FORMAT text)',
+            io.StringIO(CopyPostgresSaver.copy_rows(rows, FIELDS)))
+        cursor.execute('SELECT description, rating, file_path FROM film_work ORDER BY id;')
+        assert cursor.fetchall() == [(None, None, None), ('', 1.5, 'path')]
+        pg_conn.rollback()
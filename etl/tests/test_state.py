@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+from state import MemoryStorage, State, load_cursor, save_cursor
+
+
+class CountingStorage(MemoryStorage):
+    """Хранилище, считающее записи."""
+
+    def __init__(self, state=None):
+        super().__init__(state)
+        self.writes = []
+
+    def save_state(self, state: dict) -> None:
+        self.writes.append(dict(state))
+        super().save_state(state)
+
+
+def test_zero_flush_interval_does_not_flush_every_set():
+    storage = CountingStorage()
+    state = State(storage, flush_interval=0, flush_every=100)
+    for i in range(10):
+        state.set_state('key', i)
+    assert storage.writes == []
+    state.flush()
+    assert storage.writes == [{'key': 9}]
+
+
+def test_flush_every_counts_sets():
+    storage = CountingStorage()
+    state = State(storage, flush_every=3)
+    for i in range(7):
+        state.set_state('key', i)
+    assert len(storage.writes) == 2
+
+
+def test_save_cursor_writes_both_keys_at_once():
+    storage = CountingStorage()
+    state = State(storage)
+    modified = datetime(2021, 6, 16, 20, 14, 9, tzinfo=timezone.utc)
+    save_cursor(state, 'film_work', (modified, 'abc'))
+    assert storage.writes == [{'film_work_modified': modified.isoformat(), 'film_work_id': 'abc'}]
+    assert load_cursor(State(storage), 'film_work') == (modified.isoformat(), 'abc')
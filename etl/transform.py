@@ -0,0 +1,28 @@
+import itertools
+import logging
+
+from pydantic import ValidationError
+
+from load_to_elastic import RawDocument
+
+
+def raw_transform(schema, validate_every: int):
+    """Преобразование готовых json-документов из Postgres без pydantic.
+
+    Каждый validate_every-й документ выборочно проверяется схемой, 0
+    отключает проверку.
+    """
+    counter = itertools.count()
+
+    def transform(rows) -> list[RawDocument]:
+        docs = [RawDocument(row['id'], row['doc'].encode()) for row in rows]
+        if validate_every:
+            for doc in docs:
+                if next(counter) % validate_every:
+                    continue
+                try:
+                    schema.parse_raw(doc.source)
+                except ValidationError as ex:
+                    logging.error(f'Document {doc.id} does not match {schema.__name__}: {ex}')
+        return docs
+    return transform
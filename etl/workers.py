@@ -0,0 +1,58 @@
+import logging
+import multiprocessing
+import time
+from typing import Callable
+
+from sharding import Shard
+
+
+class Supervisor:
+    """Запускает воркеры ETL по шардам и перезапускает упавшие.
+
+    Каждый воркер получает свой Shard, держит свое соединение с Postgres
+    и свое пространство имен состояния.
+    """
+
+    def __init__(self, target: Callable[[Shard], None], count: int,
+                 restart_delay: float = 1, max_restart_delay: float = 60):
+        self.target = target
+        self.count = count
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.context = multiprocessing.get_context('spawn')
+
+    def _start(self, shard: Shard) -> multiprocessing.Process:
+        process = self.context.Process(
+            target=self.target, args=(shard,), name=f'etl-worker-{shard.index}', daemon=True)
+        process.start()
+        logging.info(f'Worker {shard.index}/{shard.count} started, pid {process.pid}')
+        return process
+
+    def run(self) -> None:
+        shards = [Shard(index, self.count) for index in range(self.count)]
+        processes = {shard: self._start(shard) for shard in shards}
+        delays = {shard: self.restart_delay for shard in shards}
+        started = {shard: time.monotonic() for shard in shards}
+        next_start: dict[Shard, float] = {}
+        try:
+            while True:
+                now = time.monotonic()
+                for shard, process in processes.items():
+                    if process.is_alive() or shard in next_start:
+                        continue
+                    logging.error(f'Worker {shard.index} exited with code {process.exitcode}')
+                    if now - started[shard] > self.max_restart_delay:
+                        delays[shard] = self.restart_delay
+                    next_start[shard] = now + delays[shard]
+                    delays[shard] = min(delays[shard] * 2, self.max_restart_delay)
+                for shard, start_at in list(next_start.items()):
+                    if now >= start_at:
+                        del next_start[shard]
+                        processes[shard] = self._start(shard)
+                        started[shard] = now
+                time.sleep(1)
+        finally:
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.join()